@@ -0,0 +1,655 @@
+# Benchmarks for busmapgen.py - run from the same folder as busmapgen.py, e.g:
+#   python3 benchmark.py parse            compare the fast route page parser against BeautifulSoup
+#   python3 benchmark.py projection       compare the numpy projection and segment checks against the per point versions
+#   python3 benchmark.py lod              count and time the vertices drawn at each level of detail in the geometry pack
+#   python3 benchmark.py generate FOLDER  write a synthetic routes.csv, operator-colors.csv, cities.csv and geometry folder to benchmark with
+#   python3 benchmark.py phases           time each phase of drawing a map with pillow and pygame, and save the results as json
+#   python3 benchmark.py startup          time how long busmapgen.py takes to start, import and reuse an already drawn map
+#   python3 benchmark.py downloads        check retries, backoff, failures and download threads against a local stub server
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+import contextlib
+import io
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import busmapgen
+import pygame
+from colorama import Fore
+from PIL import Image, ImageDraw
+
+
+def best_time(function, *args, repeat=5):  # best of several runs, in seconds, so background noise doesnt count
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def print_result(name, seconds, baseline=None):
+    line = f"{Fore.CYAN}{name:<40}{Fore.YELLOW}{seconds * 1000:>10.2f} ms"
+    if baseline:
+        line += f"  {Fore.GREEN}{baseline / seconds:.1f}x"
+    print(line)
+
+
+PARSER_PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser-pages")  # small set of made up pages covering the layouts the parsers handle
+
+def benchmark_parse(args):  # checks parse_service_page_lxml against the original parser on saved route pages, then times both
+    pages_dir = args.pages or busmapgen.SERVICE_PAGES_DIR or PARSER_PAGES_DIR
+    if not os.path.isdir(pages_dir):
+        print(f"{Fore.RED}No saved route pages found {Fore.WHITE}- {Fore.CYAN}{pages_dir} doesnt exist, pass a folder of .html pages")
+        return 1
+
+    pages = {}
+    for filename in sorted(os.listdir(pages_dir)):
+        if filename.endswith(".html"):
+            with open(os.path.join(pages_dir, filename), encoding="utf-8") as f:
+                pages[filename] = f.read()
+    print(f"{Fore.GREEN}Loaded {len(pages)} route pages from {Fore.YELLOW}{pages_dir}")
+    if not pages:
+        print(f"{Fore.RED}There are no .html pages in {pages_dir}")
+        return 1
+
+    # expected.json has the right results for pages that are kept with the script, so both parsers going wrong the same way is caught too
+    known = {}
+    if os.path.isfile(os.path.join(pages_dir, "expected.json")):
+        with open(os.path.join(pages_dir, "expected.json"), encoding="utf-8") as f:
+            known = json.load(f)
+
+    mismatches = 0
+    for filename, html in pages.items():
+        expected = busmapgen.parse_service_page_soup(html)
+        actual = busmapgen.parse_service_page(html)
+        if actual != expected:
+            mismatches += 1
+            print(f"{Fore.RED}Mismatch in {filename}: {Fore.YELLOW}{actual} {Fore.RED}!= {Fore.YELLOW}{expected}")
+        elif filename in known and actual != known[filename]:
+            mismatches += 1
+            print(f"{Fore.RED}Both parsers got {filename} wrong: {Fore.YELLOW}{actual} {Fore.RED}!= {Fore.YELLOW}{known[filename]}")
+
+    if mismatches:
+        print(f"{Fore.RED}{mismatches} of {len(pages)} pages parsed differently")
+    else:
+        print(f"{Fore.GREEN}All pages parsed identically")
+
+    def parse_all(parser):
+        for html in pages.values():
+            parser(html)
+
+    soup_time = best_time(parse_all, busmapgen.parse_service_page_soup, repeat=args.repeat)
+    lxml_time = best_time(parse_all, busmapgen.parse_service_page, repeat=args.repeat)
+    print_result("BeautifulSoup (html.parser)", soup_time)
+    print_result("lxml", lxml_time, soup_time)
+    return 1 if mismatches else 0
+
+
+def random_lines(count, vertices, seed=1):  # random walks around the UK, used when there is no geometry pack to benchmark with
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        lon, lat = rnd.uniform(-5, 1.5), rnd.uniform(50.5, 55.5)
+        line = []
+        for _ in range(vertices):
+            lon += rnd.uniform(-0.005, 0.005)
+            lat += rnd.uniform(-0.005, 0.005)
+            line.append((lon, lat))
+        lines.append(np.array(line))
+    return lines
+
+def benchmark_projection(args):  # checks geo_to_pixel_array and segment_too_long_array give the same results as the per point functions, then times both
+    geometry_store = busmapgen.open_geometry_store()
+    if geometry_store is not None and len(geometry_store):
+        routes = []
+        for service_id in list(geometry_store.index)[:args.routes]:
+            geom_type, lines = geometry_store.get(service_id)
+            if geom_type:
+                routes.append([line for line in lines if len(line)])
+        print(f"{Fore.GREEN}Loaded {len(routes)} routes from {Fore.YELLOW}{busmapgen.GEOMETRY_PACK}")
+    else:
+        routes = [[line] for line in random_lines(args.routes, 200)]
+        print(f"{Fore.GREEN}No geometry pack found, using {len(routes)} random routes")
+
+    vertices = sum(len(line) for route in routes for line in route)
+    print(f"{Fore.GREEN}{vertices} vertices")
+
+    min_lon, min_lat, max_lon, max_lat = busmapgen.BOUNDING_BOX
+    m_per_deg_lat, m_per_deg_lon = busmapgen.meters_per_degree((min_lat + max_lat) / 2)
+    scale = busmapgen.SCALE_M_PER_PX
+    list_routes = [[line.tolist() for line in route] for route in routes]  # the old code worked on lists from json
+
+    def project_points():
+        return [
+            [[busmapgen.geo_to_pixel(lon, lat, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, scale) for lon, lat in line] for line in route]
+            for route in list_routes
+        ]
+
+    def project_arrays():
+        return [
+            [busmapgen.geo_to_pixel_array(line, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, scale) for line in route]
+            for route in routes
+        ]
+
+    def check_points():
+        return [busmapgen.segment_too_long(route, m_per_deg_lat, m_per_deg_lon) for route in list_routes]
+
+    def check_arrays():
+        return [busmapgen.segment_too_long_array(route, m_per_deg_lat, m_per_deg_lon) for route in routes]
+
+    expected = project_points()
+    actual = [[[tuple(point) for point in line.tolist()] for line in route] for route in project_arrays()]
+    projection_matches = expected == actual
+    checks_match = check_points() == check_arrays()
+    print(f"{Fore.GREEN if projection_matches else Fore.RED}Projection {'matches' if projection_matches else 'does not match'}")
+    print(f"{Fore.GREEN if checks_match else Fore.RED}Segment checks {'match' if checks_match else 'do not match'}")
+
+    points_time = best_time(project_points, repeat=args.repeat)
+    print_result("geo_to_pixel", points_time)
+    print_result("geo_to_pixel_array", best_time(project_arrays, repeat=args.repeat), points_time)
+    points_time = best_time(check_points, repeat=args.repeat)
+    print_result("segment_too_long", points_time)
+    print_result("segment_too_long_array", best_time(check_arrays, repeat=args.repeat), points_time)
+    return 0 if projection_matches and checks_match else 1
+
+def benchmark_lod(args):  # how many vertices each level of detail in the geometry pack has, and how long they take to project
+    geometry_store = busmapgen.open_geometry_store()
+    if geometry_store is None or not len(geometry_store):
+        print(f"{Fore.RED}No geometry pack found {Fore.WHITE}- {Fore.CYAN}run busmapgen.py with USE_GEOMETRY_PACK = True first")
+        return 1
+
+    scale = args.scale or busmapgen.SCALE_M_PER_PX
+    min_lon, min_lat, max_lon, max_lat = busmapgen.BOUNDING_BOX
+    m_per_deg_lat, m_per_deg_lon = busmapgen.meters_per_degree((min_lat + max_lat) / 2)
+    print(f"{Fore.GREEN}{len(geometry_store)} routes, {scale} m/px draws level {Fore.YELLOW}{busmapgen.lod_level(scale)}")
+
+    baseline = None
+    for level, tolerance_m in enumerate(geometry_store.tolerances):
+        routes = [geometry_store.get(service_id, level)[1] for service_id in geometry_store.index]
+        vertices = sum(len(line) for lines in routes for line in lines)
+
+        def project():
+            for lines in routes:
+                for line in lines:
+                    busmapgen.geo_to_pixel_array(line, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, scale)
+
+        seconds = best_time(project, repeat=args.repeat)
+        print_result(f"level {level} ({tolerance_m:g} m, {vertices} vertices)", seconds, baseline)
+        baseline = baseline or seconds
+    return 0
+
+def random_road(rnd, start, vertices, step_m):  # random walk that mostly keeps going the same way, so it looks more like a road than noise
+    m_per_deg_lat, m_per_deg_lon = busmapgen.meters_per_degree(start[1])
+    headings = rnd.uniform(0, 2 * np.pi) + np.cumsum(rnd.normal(0, 0.3, vertices - 1))
+    steps = rnd.uniform(0.3, 1.7, vertices - 1) * step_m
+    offsets = np.column_stack((np.cos(headings) * steps / m_per_deg_lon, np.sin(headings) * steps / m_per_deg_lat))
+    return np.vstack((start, start + np.cumsum(offsets, axis=0)))
+
+def generate_dataset(args):  # synthetic data in the same formats as the real files, routes are clustered around towns like real ones
+    rnd = np.random.default_rng(args.seed)
+    data_dir = os.path.join(args.folder, busmapgen.DATA_DIR)
+    geometry_dir = os.path.join(args.folder, busmapgen.GEOMETRY_DIR)
+    for folder in (data_dir, geometry_dir, os.path.join(args.folder, busmapgen.MAPS_DIR)):
+        os.makedirs(folder, exist_ok=True)
+
+    min_lon, min_lat, max_lon, max_lat = -5.5, 50.3, 1.5, 57.5  # the busy part of the UK
+    towns = np.column_stack((rnd.uniform(min_lon, max_lon, args.towns), rnd.uniform(min_lat, max_lat, args.towns)))
+    town_sizes = rnd.pareto(1.2, args.towns) + 1  # a few big cities and lots of small towns
+    town_weights = town_sizes / town_sizes.sum()
+
+    operators = ["".join(rnd.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), 4)) for _ in range(args.operators)]
+    with open(os.path.join(args.folder, busmapgen.OPERATOR_COLORS_CSV), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["operator", "color_r", "color_g", "color_b"])
+        for operator in operators[: len(operators) * 3 // 4]:  # some operators have no color, like the real file
+            writer.writerow([operator, *rnd.integers(40, 256, 3)])
+
+    with open(os.path.join(args.folder, busmapgen.CITIES_CSV), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "longitude", "latitude"])
+        for number in np.argsort(-town_sizes)[: args.towns // 10]:
+            writer.writerow([f"Town {number}", round(towns[number, 0], 5), round(towns[number, 1], 5)])
+
+    rows = []
+    vertex_count = 0
+    for number in range(args.routes):
+        service_id = 100000 + number * 7
+        home = towns[rnd.choice(args.towns, p=town_weights)]
+        line_count = 1 if rnd.random() < 0.7 else 2  # many routes have a separate line for each direction
+        lines = []
+        for _ in range(line_count):
+            start = home + rnd.normal(0, 0.05, 2)
+            line = random_road(rnd, start, max(2, int(rnd.poisson(args.vertices))), args.step)
+            if rnd.random() < 0.01:
+                line[len(line) // 2:] += rnd.uniform(1, 3, 2)  # a jump like a bad coach route, for the segment length filter
+            lines.append(line)
+
+        vertices = np.concatenate(lines)
+        vertex_count += len(vertices)
+        extent = [*vertices.min(axis=0).tolist(), *vertices.max(axis=0).tolist()]
+        if rnd.random() < 0.995:  # a few routes have no geometry
+            if rnd.random() < 0.005:
+                geometry = {"type": "Point", "coordinates": lines[0][0].round(6).tolist()}
+            elif line_count == 1:
+                geometry = {"type": "LineString", "coordinates": lines[0].round(6).tolist()}
+            else:
+                geometry = {"type": "MultiLineString", "coordinates": [line.round(6).tolist() for line in lines]}
+            with open(os.path.join(geometry_dir, f"{service_id}.json"), "w", encoding="utf-8") as f:
+                json.dump({"id": service_id, "geometry": geometry}, f)
+
+        rows.append({
+            "serviceID": service_id,
+            "extent": json.dumps(extent),
+            "routeNumber": str(rnd.integers(1, 999)) + ("" if rnd.random() < 0.8 else str(rnd.choice(list("ABCX")))),
+            "frequency": int(rnd.lognormal(3, 1.3)),
+            "isPublicService": str(rnd.random() < 0.9),
+            "mode": str(rnd.choice(["bus", "coach", "tram", "ferry"], p=[0.9, 0.06, 0.02, 0.02])),
+            "operator": str(rnd.choice(operators)),
+        })
+        if number % 1000 == 999:
+            print(f"{Fore.CYAN}Generated {Fore.YELLOW}{number + 1}{Fore.CYAN}/{Fore.GREEN}{args.routes}", end="\r")
+
+    rows.sort(key=lambda row: row["frequency"])  # routes.csv is sorted by frequency, so busier routes are drawn on top
+    with open(os.path.join(args.folder, busmapgen.ROUTES_CSV), "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=busmapgen.ROUTES_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"{Fore.GREEN}Generated {Fore.YELLOW}{args.routes}{Fore.GREEN} routes with {Fore.YELLOW}{vertex_count}{Fore.GREEN} vertices in {Fore.YELLOW}{args.folder}")
+    return 0
+
+
+def timed(results, name, function, *args, repeat=1):  # records the best time of function under name, returns what it returned
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    results[name] = best
+    return result
+
+def git_commit():  # the version being benchmarked, so results from different versions can be told apart
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(busmapgen.__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def draw_backend(headless, routes, width_px, height_px, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, output_path, repeat):
+    # the rasterisation, labels and PNG encode phases of main() with pillow or pygame, returns {phase: seconds}
+    busmapgen.HEADLESS_RENDERING = headless  # fonts for each backend are loaded the first time labels are drawn
+    results = {}
+
+    def rasterise():
+        if headless:
+            screen = Image.new("RGBA", (width_px, height_px), busmapgen.BACKGROUND_COLOR)
+            draw = ImageDraw.Draw(screen)
+        else:
+            screen = pygame.Surface((width_px, height_px))
+            screen.fill(busmapgen.BACKGROUND_COLOR)
+        for color, width, lines, _, _ in routes:
+            for points in lines:
+                if headless:
+                    draw.line(points, fill=color, width=width)
+                else:
+                    pygame.draw.lines(screen, color, False, points, width)
+        return screen
+
+    def labels(screen):
+        busmapgen.text_size.cache_clear()  # a real run starts with nothing cached
+        busmapgen.label_sprite.cache_clear()
+        route_labels = [  # main() labels each route at its last line
+            {"routeNumber": route_number, "frequency": frequency, "color": color, "points": lines[-1]}
+            for color, width, lines, route_number, frequency in routes if lines
+        ]
+        busmapgen.draw_route_labels(screen, route_labels, m_per_deg_lat, m_per_deg_lon)
+        busmapgen.draw_city_labels(screen, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+
+    def encode(screen):
+        if headless:
+            screen.save(output_path)
+        else:
+            pygame.image.save(screen, output_path)
+
+    screen = timed(results, "rasterisation", rasterise, repeat=repeat)
+    timed(results, "labels", labels, screen, repeat=repeat)
+    timed(results, "PNG encode", encode, screen, repeat=repeat)
+    return results
+
+def benchmark_phases(args):  # times each phase of drawing BOUNDING_BOX the way main() does, for both backends
+    output = os.path.abspath(args.output)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.data:
+        os.chdir(args.data)  # every path in busmapgen is relative to the folder it is run from
+    if not os.path.isfile(busmapgen.ROUTES_CSV) or not os.path.isdir(busmapgen.GEOMETRY_DIR):
+        print(f"{Fore.RED}No data found {Fore.WHITE}- {Fore.CYAN}run from a folder with data, pass --data, or make some with python3 benchmark.py generate")
+        return 1
+
+    if args.scale:
+        busmapgen.SCALE_M_PER_PX = args.scale
+    min_lon, min_lat, max_lon, max_lat = busmapgen.BOUNDING_BOX
+    m_per_deg_lat, m_per_deg_lon = busmapgen.meters_per_degree((min_lat + max_lat) / 2)
+    scale = busmapgen.SCALE_M_PER_PX
+    width_px = int((max_lon - min_lon) * m_per_deg_lon / scale)
+    height_px = int((max_lat - min_lat) * m_per_deg_lat / scale)
+
+    phases = {}
+    timed(phases, "data check", busmapgen.check_data)  # includes compiling the route table and geometry pack if they are out of date
+    timed(phases, "CSV scan", busmapgen.build_route_table, repeat=args.repeat)
+
+    operator_colors = busmapgen.load_operator_colors(busmapgen.OPERATOR_COLORS_CSV)
+    geometry_store = busmapgen.open_geometry_store()
+    table, rows, total_routes = timed(phases, "filtering", busmapgen.select_routes, operator_colors, m_per_deg_lat, m_per_deg_lon, busmapgen.FilterStats(), repeat=args.repeat)
+    level = busmapgen.lod_level(scale)
+    routes = timed(phases, "geometry load", lambda: list(busmapgen.iter_routes(
+        table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, busmapgen.FilterStats(), status="Loading", level=level
+    )), repeat=args.repeat)
+    print()
+
+    def project():
+        return [
+            (route["color"], route["width"], [
+                busmapgen.geo_to_pixel_array(line, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, scale).tolist()
+                for line in route["lines"] if len(line) >= 2
+            ], route["route_number"], route["frequency"])
+            for route in routes
+        ]
+
+    projected = timed(phases, "projection", project, repeat=args.repeat)
+    vertices = sum(len(points) for _, _, lines, _, _ in projected for points in lines)
+
+    backends = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for backend, headless in (("pillow", True), ("pygame", False)):
+            backends[backend] = draw_backend(headless, projected, width_px, height_px, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, os.path.join(temp_dir, f"{backend}.png"), args.repeat)
+    if geometry_store is not None:
+        geometry_store.close()
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "bounding_box": list(busmapgen.BOUNDING_BOX),
+        "scale_m_per_px": scale,
+        "image_size": [width_px, height_px],
+        "total_routes": total_routes,
+        "drawn_routes": len(routes),
+        "vertices": vertices,
+        "phases": phases,
+        "backends": backends,
+    }
+
+    print(f"{Fore.GREEN}{len(routes)} of {total_routes} routes, {vertices} vertices, {width_px}x{height_px} px at level {level}")
+    for name, seconds in phases.items():
+        print_result(name, seconds, baseline.get("phases", {}).get(name))
+    for backend, results in backends.items():
+        for name, seconds in results.items():
+            print_result(f"{backend} {name}", seconds, baseline.get("backends", {}).get(backend, {}).get(name))
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"{Fore.GREEN}Saved results to {Fore.YELLOW}{output}")
+    return 0
+
+
+
+STARTUP_CASES = {  # python run in a fresh process for each case, busmapgen is imported from the folder benchmark.py is in
+    # what importing busmapgen used to cost, everything imported and the pygame fonts found before anything else happens
+    "import everything up front": "import pygame, requests, bs4, lxml.etree, lxml.html, PIL.Image, PIL.ImageDraw, PIL.ImageFont; pygame.font.init(); pygame.font.SysFont(None, 20); import busmapgen",
+    "import": "import busmapgen",
+    "dry run": "import busmapgen; busmapgen.HEADLESS_RENDERING = True; busmapgen.dry_run()",
+    "cached headless render": "import busmapgen; busmapgen.HEADLESS_RENDERING = True; busmapgen.record_renders([busmapgen.render_output()[:2]])",
+}
+LAZY_MODULES = ("pygame", "requests", "bs4", "lxml.etree", "PIL.Image")
+
+def benchmark_startup(args):  # times each startup case in new python processes, the way a user or a tile request would start the script
+    script_dir = os.path.dirname(os.path.abspath(busmapgen.__file__))
+    data_dir = os.path.abspath(args.data or ".")
+    env = dict(os.environ, PYTHONPATH=script_dir + os.pathsep + os.environ.get("PYTHONPATH", ""), SDL_VIDEODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    report = "; import sys, json; print('\\n' + json.dumps([name for name in %r if name in sys.modules]))" % (LAZY_MODULES,)
+
+    print(f"{Fore.GREEN}Timing startup from {Fore.YELLOW}{data_dir}{Fore.GREEN}, best of {args.repeat} runs")
+    # the first cached render draws the map if it hasnt been drawn yet, so its left out of the timings
+    subprocess.run([sys.executable, "-c", STARTUP_CASES["cached headless render"]], cwd=data_dir, env=env, capture_output=True)
+
+    results = {}
+    for name, code in STARTUP_CASES.items():
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", code + report], cwd=data_dir, env=env, capture_output=True, text=True)
+            best = min(best, time.perf_counter() - start)
+            if process.returncode:
+                print(f"{Fore.RED}{name} failed {Fore.WHITE}- {Fore.YELLOW}{process.stderr.strip().splitlines()[-1]}")
+                break
+            imported = json.loads(process.stdout.strip().splitlines()[-1])
+        else:
+            results[name] = {"seconds": best, "imported": imported}
+            print_result(name, best, results.get("import everything up front", {}).get("seconds") if name != "import everything up front" else None)
+            print(f"  {Fore.CYAN}imported: {Fore.YELLOW}{', '.join(imported) or 'none of ' + ', '.join(LAZY_MODULES)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "python": platform.python_version(), "results": results}, f, indent=1)
+        print(f"\n{Fore.GREEN}Saved to {Fore.YELLOW}{args.output}")
+
+
+class StubHandler(BaseHTTPRequestHandler):  # a server that fails in the ways bustimes.org can, every request is counted by path
+    # /ok, /flaky/NAME/N fails N times then works, /limited/NAME is rate limited once, /down always fails, /drop hangs up,
+    # /slow takes a moment so overlapping requests can be counted, /conditional is 304 if the request has If-Modified-Since or If-None-Match,
+    # /geometry/ID is one of those depending on the ID
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] += 1
+            server.headers[self.path] = dict(self.headers)
+            count = server.requests[self.path]
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "geometry":
+            parts = {"1": ["ok"], "2": ["flaky", "geometry", "2"], "3": ["down"], "4": ["drop"], "5": ["conditional"]}.get(parts[1], ["missing"])
+
+        if parts[0] == "ok":
+            self.reply(200)
+        elif parts[0] == "flaky":
+            self.reply(503 if count <= int(parts[2]) else 200)
+        elif parts[0] == "limited":
+            self.reply(429 if count == 1 else 200, {"Retry-After": "0"})
+        elif parts[0] == "down":
+            self.reply(500)
+        elif parts[0] == "drop":
+            self.close_connection = True  # closed without a response, requests raises ConnectionError
+        elif parts[0] == "conditional":
+            self.reply(304 if "If-Modified-Since" in self.headers or "If-None-Match" in self.headers else 200)
+        elif parts[0] == "slow":
+            with server.lock:
+                server.in_flight += 1
+                server.most_in_flight = max(server.most_in_flight, server.in_flight)
+            time.sleep(0.05)
+            with server.lock:
+                server.in_flight -= 1
+            self.reply(200)
+        else:
+            self.reply(404)
+
+    def reply(self, code, headers={}):
+        body = json.dumps({"geometry": {"type": "LineString", "coordinates": [[-2.2, 53.4], [-2.1, 53.5]]}}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if code != 304:  # a 304 has no body
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def benchmark_downloads(args):  # checks fetch, run_in_threads and download_geometry against StubHandler, nothing is sent to bustimes.org
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = defaultdict(int)
+    server.headers = {}
+    server.in_flight = server.most_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["NO_PROXY"] = "127.0.0.1"  # a proxy set in the environment cant reach the stub
+
+    busmapgen.DOWNLOAD_RETRIES = args.retries
+    busmapgen.DOWNLOAD_BACKOFF = 0.01
+    busmapgen.DOWNLOAD_RATE_LIMIT = 0
+    busmapgen.run_report = busmapgen.RunReport()
+    session = busmapgen.make_session()
+    rate_limiter = busmapgen.RateLimiter(0)
+    attempts = args.retries + 1
+    checks = []
+
+    def check(name, passed, detail):
+        checks.append(passed)
+        print(f"{Fore.GREEN + 'ok    ' if passed else Fore.RED + 'FAILED'} {Fore.CYAN}{name:<45}{Fore.YELLOW}{detail}")
+
+    r = busmapgen.fetch(session, base_url + "/flaky/a/2", rate_limiter)
+    check("retried then worked", r.status_code == 200 and server.requests["/flaky/a/2"] == 3, f"{r.status_code} after {server.requests['/flaky/a/2']} requests")
+    r = busmapgen.fetch(session, base_url + "/limited/a", rate_limiter)
+    check("rate limited then worked", r.status_code == 200 and server.requests["/limited/a"] == 2, f"{r.status_code} after {server.requests['/limited/a']} requests")
+    r = busmapgen.fetch(session, base_url + "/down", rate_limiter)
+    check("server error on every retry", r.status_code == 500 and server.requests["/down"] == attempts, f"{r.status_code} after {server.requests['/down']} requests")
+    start = time.perf_counter()
+    try:
+        busmapgen.fetch(session, base_url + "/drop", rate_limiter)
+        error = None
+    except busmapgen.requests.RequestException as e:
+        error = e
+    backoff = sum(0.01 * 2 ** attempt for attempt in range(args.retries))
+    check("connection dropped on every retry", error is not None and server.requests["/drop"] == attempts, f"{type(error).__name__} after {server.requests['/drop']} requests")
+    check("backed off between retries", time.perf_counter() - start >= backoff, f"{time.perf_counter() - start:.2f}s, at least {backoff:.2f}s")
+    r = busmapgen.fetch(session, base_url + "/missing", rate_limiter)
+    check("404 not retried", r.status_code == 404 and server.requests["/missing"] == 1, f"{r.status_code} after {server.requests['/missing']} requests")
+    counts = busmapgen.run_report.counts
+    check("failed requests counted", counts["http requests failed"] == 2, f"{counts['http requests failed']} failed, {counts['http retries']} retries")
+
+    done = []
+    errors = busmapgen.run_in_threads(lambda item: done.append(busmapgen.fetch(session, f"{base_url}/slow", rate_limiter).status_code), range(args.items), args.workers)
+    check("every item done on its own thread", len(done) == args.items and not errors and server.most_in_flight == args.workers, f"{len(done)} done, at most {server.most_in_flight} at once")
+
+    def fail_some(item):
+        if item % 7 == 0:
+            raise ValueError(item)
+        done.append(item)
+    done = []
+    errors = busmapgen.run_in_threads(fail_some, range(args.items), args.workers)
+    failed = sorted(item for item, _ in errors)
+    check("errors returned, other items still done", failed == list(range(0, args.items, 7)) and len(done) == args.items - len(failed), f"{len(failed)} errors, {len(done)} done")
+
+    # the whole geometry download against the stub, 1 works, 2 works on a retry, 3 always fails and 4 always hangs up,
+    # 5 is an old file extracted from the zip that has to be rechecked with If-Modified-Since rather than downloaded again
+    busmapgen.GEOMETRY_BASE_URL = base_url + "/geometry/{}"
+    busmapgen.run_report = busmapgen.RunReport()
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            os.makedirs(busmapgen.GEOMETRY_DIR)
+            os.makedirs(busmapgen.DATA_DIR, exist_ok=True)
+            with open(busmapgen.ROUTES_CSV, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=busmapgen.ROUTES_FIELDNAMES)
+                writer.writeheader()
+                for service_id in range(1, 6):
+                    writer.writerow({"serviceID": service_id, "extent": "[-2.2, 53.4, -2.1, 53.5]", "routeNumber": service_id, "frequency": 1, "isPublicService": True})
+            legacy_path = os.path.join(busmapgen.GEOMETRY_DIR, "5.json")
+            with open(legacy_path, "w", encoding="utf-8") as f:
+                f.write("legacy")
+            legacy_mtime = time.time() - (busmapgen.GEOMETRY_MAX_AGE_DAYS + 10) * 86400
+            os.utime(legacy_path, (legacy_mtime, legacy_mtime))
+            os.utime(busmapgen.GEOMETRY_DIR, (legacy_mtime, legacy_mtime))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                busmapgen.download_geometry()
+            downloaded = sorted(busmapgen.load_geometry_ids())
+            with open(legacy_path, encoding="utf-8") as f:
+                legacy_kept = f.read() == "legacy"
+        finally:
+            os.chdir(previous_dir)
+    failed = sorted(busmapgen.run_report.failures["geometry"])
+    summary = [line for line in output.getvalue().splitlines() if "failed after" in line]
+    check("geometry download kept what worked", downloaded == [1, 2, 5], f"downloaded {downloaded}")
+    sent = server.headers.get("/geometry/5", {}).get("If-Modified-Since")
+    expected = busmapgen.formatdate(int(legacy_mtime), usegmt=True)
+    check("zip geometry rechecked, not downloaded again", sent == expected and legacy_kept, f"If-Modified-Since: {sent}")
+    check("geometry failures in the run report", failed == [3, 4], f"failed {failed}")
+    check("geometry failures in the summary", len(summary) == 1 and "2 geometry downloads failed" in summary[0], summary[0].strip() if summary else "no summary line")
+
+    server.shutdown()
+    session.close()
+    print(f"\n{Fore.GREEN if all(checks) else Fore.RED}{checks.count(True)} of {len(checks)} checks passed")
+    return 0 if all(checks) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for busmapgen.py")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="check and time the fast route page parser")
+    parse_parser.add_argument("pages", nargs="?", help="folder of saved route pages, defaults to SERVICE_PAGES_DIR or the pages in parser-pages")
+    parse_parser.add_argument("--repeat", type=int, default=3)
+    parse_parser.set_defaults(function=benchmark_parse)
+
+    projection_parser = subparsers.add_parser("projection", help="check and time the numpy projection and segment length checks")
+    projection_parser.add_argument("--routes", type=int, default=2000, help="number of routes to use")
+    projection_parser.add_argument("--repeat", type=int, default=3)
+    projection_parser.set_defaults(function=benchmark_projection)
+
+    lod_parser = subparsers.add_parser("lod", help="count and time the vertices at each level of detail")
+    lod_parser.add_argument("--scale", type=float, help="meters per pixel used to pick a level, defaults to SCALE_M_PER_PX")
+    lod_parser.add_argument("--repeat", type=int, default=3)
+    lod_parser.set_defaults(function=benchmark_lod)
+
+    generate_parser = subparsers.add_parser("generate", help="write a synthetic data set in the same formats as the real one")
+    generate_parser.add_argument("folder", help="folder to write data, geometry and maps folders to, run busmapgen.py or benchmark.py phases from here to use it")
+    generate_parser.add_argument("--routes", type=int, default=30000, help="number of routes, about the same as the whole UK")
+    generate_parser.add_argument("--towns", type=int, default=1000, help="number of towns the routes are spread between, fewer makes the routes denser")
+    generate_parser.add_argument("--vertices", type=int, default=150, help="average vertices per line")
+    generate_parser.add_argument("--step", type=float, default=100, help="average meters between vertices")
+    generate_parser.add_argument("--operators", type=int, default=400)
+    generate_parser.add_argument("--seed", type=int, default=1)
+    generate_parser.set_defaults(function=generate_dataset)
+
+    phases_parser = subparsers.add_parser("phases", help="time each phase of drawing a map with pillow and pygame")
+    phases_parser.add_argument("--data", help="folder with the data to use, defaults to the current folder")
+    phases_parser.add_argument("--scale", type=float, help="meters per pixel, defaults to SCALE_M_PER_PX")
+    phases_parser.add_argument("--output", default="benchmark-phases.json", help="json file to save the results to")
+    phases_parser.add_argument("--baseline", help="results saved by an earlier run to compare against")
+    phases_parser.add_argument("--repeat", type=int, default=3, help="every phase but the data check is run this many times and the best time is kept")
+    phases_parser.set_defaults(function=benchmark_phases)
+
+    startup_parser = subparsers.add_parser("startup", help="time how long the script takes to start in a new process")
+    startup_parser.add_argument("--data", help="folder with the data to use, defaults to the current folder")
+    startup_parser.add_argument("--output", help="json file to save the results to")
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.set_defaults(function=benchmark_startup)
+
+    downloads_parser = subparsers.add_parser("downloads", help="check retries, failures and download threads against a local stub server")
+    downloads_parser.add_argument("--retries", type=int, default=3, help="DOWNLOAD_RETRIES to check with")
+    downloads_parser.add_argument("--workers", type=int, default=4, help="threads to check run_in_threads with")
+    downloads_parser.add_argument("--items", type=int, default=40)
+    downloads_parser.set_defaults(function=benchmark_downloads)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
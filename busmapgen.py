@@ -5,20 +5,60 @@ try:
     import sys
     import re
     import time
-    import pygame
-    import requests
-    from math import cos, radians, sqrt
-    from collections import defaultdict
+    import mmap
+    import struct
+    import threading
+    import queue
+    import zlib
+    import contextlib
+    import cProfile
+    import tracemalloc
+    import hashlib
+    import io
+    import shutil
+    import importlib
+    import importlib.util
+    import numpy as np
+    from math import atan, cos, degrees, floor, nan, pi, radians, sinh, sqrt
+    from collections import OrderedDict, defaultdict, deque
+    from email.utils import formatdate
+    from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+    from functools import lru_cache, wraps
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
     from colorama import init, Fore, Style
-    from bs4 import BeautifulSoup
-    from PIL import Image, ImageDraw, ImageFont
+    if any(importlib.util.find_spec(name) is None for name in ("pygame", "requests", "bs4", "lxml", "PIL")):  # finds them without importing them
+        raise ModuleNotFoundError
 except ModuleNotFoundError:
     print(
         "\033[31mOne or more dependencies are missing! To install required dependencies run:\033[0m"
     )  # cant use colorama because its not initialised yet
-    print("pip install pygame colorama requests beautifulsoup4 lxml pillow")
+    print("pip install pygame colorama requests beautifulsoup4 lxml pillow numpy")
     exit(1)
 
+class LazyModule:  # imports a module the first time something in it is used, so runs that never download or never open a window dont wait for those imports
+    def __init__(self, name):
+        self.__dict__["name"] = name
+        self.__dict__["module"] = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.__dict__["module"] = importlib.import_module(self.name)  # imports are locked, so threads using it at the same time get the same module
+        return getattr(self.module, attribute)
+
+pygame = LazyModule("pygame")
+requests = LazyModule("requests")
+bs4 = LazyModule("bs4")
+lxml_etree = LazyModule("lxml.etree")
+lxml_html = LazyModule("lxml.html")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not on windows, peak memory is left out of run reports there
+
 
 # ====== CONFIGURATION ======
 # bounding box format: (lon, lat, lon, lat) - south west corner first
@@ -31,8 +71,43 @@ BOUNDING_BOX = (-10.8, 49.85, 2.1, 59.5)     # entire UK
 
 SCALE_M_PER_PX = 400  # zoom - lower numbers result in higher quality outputs but take longer to render, use headless rendering for very small values
 WINDOW_TITLE = "Bus Map Generator"
+DISPLAY_REFRESH_MS = 50  # how often the window is updated while drawing, only the parts drawn on since the last update are redrawn, 0 = update after every route (slow)
 BACKGROUND_COLOR = (20, 20, 20)
 HEADLESS_RENDERING = False  # use pillow instead of pygame, recommended for larger maps or for use in situations where you cant use pygame, labels might render slightly different.
+DRY_RUN = False  # only run the filters and print how many routes each one removes, nothing is drawn or saved
+RUN_REPORT = True  # save name.png.report.json next to each map with how long each part of the run took, how much memory it used and how much was drawn
+TRACK_MEMORY = False  # add the peak memory used by python in each part of the run to the report, slows the run down a lot
+PROFILE_RUN = False  # save a cProfile dump of the drawing next to each map as name.png.prof, open it with python -m pstats or snakeviz
+RENDER_MODE = "image"  # "image" draws one map of BOUNDING_BOX, "tiles" renders 256px web map tiles of BOUNDING_BOX into TILES_DIR instead, "heatmap" colors every pixel by how many buses a day pass through it, "svg" or "geojson" save the routes as lines that can be scaled or edited in other programs, "server" draws tiles as a browser asks for them instead of all at once
+SVG_DECIMALS = 1  # decimal places kept in svg pixel coordinates, points that round to the same place as the one before are left out, None = no rounding
+GEOJSON_DECIMALS = 5  # decimal places kept in geojson longitudes and latitudes, 5 is about a meter, None = no rounding
+HEATMAP_COLORS = [  # buses per day, color - colors in between are blended on a log scale, pixels with no buses are BACKGROUND_COLOR
+    [1, (30, 30, 90)],
+    [20, (0, 100, 200)],
+    [100, (0, 190, 140)],
+    [400, (230, 220, 0)],
+    [1500, (255, 80, 0)],
+    [5000, (255, 255, 255)],
+]
+TILE_MIN_ZOOM = 5
+TILE_MAX_ZOOM = 11  # every zoom level has 4 times as many tiles as the one before it
+TILE_SERVER_HOST = "127.0.0.1"  # "0.0.0.0" lets other computers on the network see the map too
+TILE_SERVER_PORT = 8000  # the map is at http://localhost:8000 while the server is running
+TILE_CACHE_MB = 256  # drawn tiles the server keeps in memory, the least recently used are dropped first
+TILE_CACHE_DIR = "tile-cache"  # tiles dropped from memory are saved here so they dont have to be drawn again, emptied whenever the server starts, None = dont keep them
+RENDER_WORKERS = os.cpu_count() or 1  # processes used to render tiles and banded headless maps
+STREAM_OUTPUT = False  # headless only - draw the map in strips and write each one straight into the PNG, so maps much bigger than your RAM can be made
+STRIP_HEIGHT = 256  # pixels, rows drawn at a time when STREAM_OUTPUT is on, memory used is about width * STRIP_HEIGHT * 4 bytes per worker
+RENDER_BANDS = 0  # headless only - split the map into this many horizontal bands drawn at the same time by RENDER_WORKERS processes, output is identical, 0 = draw the whole map on one core
+OUTPUT_NAME = None  # file name the map is saved as in MAPS_DIR, without .png - None = the next unused number
+BATCH_JOBS = []  # headless only - draw several maps in one run, each job is a name (saved as MAPS_DIR/name.png) and any settings from this section or the filters below that are different for that map, e.g.
+# BATCH_JOBS = [
+#     {"name": "uk"},
+#     {"name": "manchester", "BOUNDING_BOX": (-2.6, 53.3, -2, 53.65), "SCALE_M_PER_PX": 20},
+#     {"name": "london-no-tfl", "BOUNDING_BOX": (-0.6, 51.2, 0.4, 51.75), "SCALE_M_PER_PX": 30, "EXCLUDE_OPERATORS": ["TFLO"]},
+#     {"name": "uk-heatmap", "RENDER_MODE": "heatmap"},
+# ]
+BATCH_WORKERS = os.cpu_count() or 1  # batch jobs drawn at the same time, each job draws on one core unless it sets RENDER_WORKERS
 
 # this dosent really work because there is no reliable data as to what is and isnt a public route
 IGNORE_PRIVATE_ROUTES = False
@@ -129,16 +204,28 @@ DRAW_ROUTE_LABEL_BOX = True
 ROUTE_LABEL_BOX_WIDTH = 1
 ROUTE_LABEL_BOX_PADDING = 3  # gap between text and box
 ROUTE_LABEL_MAX_LENGTH = 8  # max characters
+ROUTE_LABEL_AVOID_OVERLAP = True  # labels that would overlap one already placed are moved along their route or left out, busier routes are labelled first
+ROUTE_LABEL_POSITIONS = [0.5, 0.35, 0.65, 0.2, 0.8]  # how far along the route to try placing a label, in order, if ROUTE_LABEL_AVOID_OVERLAP
+ROUTE_LABEL_DEDUPE_DISTANCE = 150  # pixels - a route number is only labelled once within this distance, if ROUTE_LABEL_AVOID_OVERLAP
 
 # data options
 GEOMETRY_DIR = "geometry"  # will be downloaded if missing from bustimes.org which takes a while, if you have slow internet ask verumIgnis for a copy, then update it with UPDATE_DATA
 MAPS_DIR = "maps"  # folder where the output will be saved
+RENDER_MANIFEST = "manifest.json"  # kept in MAPS_DIR, records the settings and data every map was drawn from
+RENDER_CACHE = True  # if a map has already been drawn with exactly the same settings and data, use it instead of drawing it again
+TILES_DIR = "tiles"  # folder where tiles are saved as TILES_DIR/zoom/x/y.png, along with an index.html to view them - copy it to any web server to publish the map
 DATA_DIR = "data"  # folder where the data CSVs are stored
 ROUTES_CSV = "routes.csv"  # will be downloaded from bustimes.org if missing which will take a while
 CITIES_CSV = "cities.csv"  # list of city names and locations - will be downloaded from verumignis.com if missing
 OPERATOR_COLORS_CSV = "operator-colors.csv"  # operator, r, g, b at max brightness - will be downloaded from verumignis.com if missing
+ROUTE_TABLE = "routes.npz"  # routes.csv compiled into typed arrays, rebuilt automatically when routes.csv changes
+GEOMETRY_INDEX = "geometry-index.json"  # ETag, Last-Modified, fetch time, size and checksum of every geometry file, so updates only download what has changed and the geometry folder isnt listed on every run
+GEOMETRY_PACK = "geometry.pack"  # all of GEOMETRY_DIR compacted into one binary file, rebuilt automatically when the geometry folder changes
+USE_GEOMETRY_PACK = True  # read geometry from GEOMETRY_PACK instead of opening one json file per route, much faster for large maps
+GEOMETRY_LOD_TOLERANCES = [10, 25, 50, 100, 250]  # meters - simplified copies of every route are stored in GEOMETRY_PACK, maps draw the most simplified copy that is off by less than half a pixel, [] = always draw every point
 UPDATE_ROUTES = False  # updates route data, recomended to also update geometry or new routes will not display properly
 UPDATE_GEOMETRY = False  # updates geometry data to be up to date with routes data
+GEOMETRY_MAX_AGE_DAYS = 30  # when updating, geometry older than this is rechecked with bustimes.org, unchanged routes cost a tiny 304 response instead of a full download
 UPDATE_DATA = False  # updates cities CSV and colors CSV
 
 # download options
@@ -155,6 +242,16 @@ HEADERS = {  # will be included with any request made to any of the above URLs
     "User-Agent": "Mozilla/5.0 (compatible; verumIgnis-busmap/1.0)"
 }
 
+DOWNLOAD_WORKERS = 8  # number of geometry requests made at the same time, set to 1 to download one route at a time
+DOWNLOAD_RATE_LIMIT = 10  # max requests per second across all workers, 0 = no limit - please be polite to bustimes.org
+DOWNLOAD_RETRIES = 3  # how many times to retry a request that fails or gets a 429/5xx response
+DOWNLOAD_BACKOFF = 1  # seconds to wait before the first retry, doubled after every retry
+SCRAPE_FETCH_WORKERS = 8  # number of route pages requested at the same time when downloading routes, shares DOWNLOAD_RATE_LIMIT
+SCRAPE_PARSE_WORKERS = os.cpu_count() or 1  # processes used to parse route pages, 0 = parse on the fetching threads
+FAST_PAGE_PARSER = True  # parse route pages with lxml instead of BeautifulSoup, gives identical results but is much faster
+SERVICE_PAGES_DIR = None  # if set, every scraped route page is saved in this folder, benchmark.py uses these to check the fast parser still matches
+SCRAPE_QUEUE_SIZE = 64  # max pages fetched but not yet saved, stops fetching getting too far ahead of parsing
+
 PRIVATE_KEYWORDS = [  # used to determine if a route is private - if any of these strings appear on the route page on bustimes.org, the route is considered private
     "not open to the public",  # filter for routes marked as private in open data (not accurate!)
     "For school students only.",
@@ -169,29 +266,67 @@ PRIVATE_KEYWORDS = [  # used to determine if a route is private - if any of thes
 ROUTES_CSV = os.path.join(DATA_DIR, ROUTES_CSV)
 CITIES_CSV = os.path.join(DATA_DIR, CITIES_CSV)
 OPERATOR_COLORS_CSV = os.path.join(DATA_DIR, OPERATOR_COLORS_CSV)
+ROUTE_TABLE = os.path.join(DATA_DIR, ROUTE_TABLE)
+ROUTE_TABLE_VERSION = 1
+GEOMETRY_INDEX = os.path.join(DATA_DIR, GEOMETRY_INDEX)
+GEOMETRY_PACK = os.path.join(DATA_DIR, GEOMETRY_PACK)
+RENDER_MANIFEST = os.path.join(MAPS_DIR, RENDER_MANIFEST)
+
+# geometry pack layout: header, then one index entry per service sorted by service ID, then one block per service
+# each block is the offset of every level of detail, then for each level the line count, the vertex count of each line, then every (lon, lat) pair as little endian doubles
+PACK_MAGIC = b"BMGP"
+PACK_VERSION = 2
+PACK_HEADER = struct.Struct("<4sIII")  # magic, version, service count, level count, followed by the tolerance of each level as doubles
+PACK_INDEX_ENTRY = struct.Struct("<IIQ")  # service ID, geometry type, block offset
+PACK_GEOMETRY_TYPES = [None, "LineString", "MultiLineString"]  # index 0 is used for anything that isnt line data
+
+PROGRESS_INTERVAL = 0.25  # seconds between progress line updates, printing a line for every route slows big maps down
+
+LABEL_GRID_SIZE = 64  # pixels, cell size of the grid used to find labels that might overlap
+PNG_COMPRESSION = 6  # zlib level used for streamed PNGs, same as pillow uses
+LABEL_SPRITE_CACHE_SIZE = 4096  # rendered labels kept for reuse, the same route numbers and colors come up again and again
+
+OUTPUT_EXTENSIONS = {"image": ".png", "heatmap": ".png", "svg": ".svg", "geojson": ".geojson"}  # by RENDER_MODE
+TILE_SIZE = 256  # pixels, the size every web map library expects
+TILE_INDEX_ZOOM = 8  # the tile server finds the routes on a tile from a grid of tiles at this zoom, deeper tiles only check the routes in the grid tile they are part of
+TILE_URL = re.compile(r"/(\d+)/(\d+)/(\d+)\.png")
+MAX_MERCATOR_LAT = 85.0511287798  # web mercator stops here so the world is square
+
+RENDER_CACHE_VERSION = 1  # bump when a change to the drawing code changes how maps look, so maps drawn before arent reused
+CACHE_KEY_SETTINGS = {  # settings that change what a map looks like, a map is only reused if all of these are the same
+    "BOUNDING_BOX", "SCALE_M_PER_PX", "BACKGROUND_COLOR", "HEADLESS_RENDERING", "RENDER_MODE", "SVG_DECIMALS", "GEOJSON_DECIMALS", "HEATMAP_COLORS",
+    "IGNORE_PRIVATE_ROUTES", "SHOW_ONLY_PRIVATE_ROUTES", "EXCLUDE_OPERATORS", "INCLUDE_OPERATORS", "EXCLUDE_MODES", "INCLUDE_MODES",
+    "MIN_ROUTE_LENGTH", "MAX_ROUTE_LENGTH", "MAX_LINE_LENGTH_METERS", "ROUTE_STYLE_BY_FREQUENCY", "SHOW_ONLY_UNCOLORED", "FLAT_EARTH", "REF_LAT",
+    "DRAW_CITY_LABELS", "CITY_LABEL_COLOR", "CITY_LABEL_ALPHA", "CITY_LABEL_FONT_SIZE", "CITY_LABEL_FONT_NAME", "CITY_LABEL_UPPERCASE",
+    "DRAW_ROUTE_LABELS", "ROUTE_LABEL_FONT_NAME", "ROUTE_LABEL_FONT_SIZE", "ROUTE_LABEL_ALPHA", "OVERRIDE_ROUTE_LABEL_COLOR", "ROUTE_LABEL_COLOR",
+    "ROUTE_LABEL_BG_COLOR", "DRAW_ROUTE_LABEL_BOX", "ROUTE_LABEL_BOX_WIDTH", "ROUTE_LABEL_BOX_PADDING", "ROUTE_LABEL_MAX_LENGTH",
+    "ROUTE_LABEL_AVOID_OVERLAP", "ROUTE_LABEL_POSITIONS", "ROUTE_LABEL_DEDUPE_DISTANCE", "USE_GEOMETRY_PACK", "GEOMETRY_LOD_TOLERANCES",
+}
 
-init(autoreset=True)  # for colorama, this MSUT only be run once
-pygame.font.init()
-
-if HEADLESS_RENDERING:
-    pygame_dir = os.path.dirname(pygame.__file__)
-    default_font_path = os.path.join(pygame_dir, "freesansbold.ttf") # use the pygame default font even in headless mode for consistency
+BATCH_FIXED_SETTINGS = {  # read when the script starts or shared by the whole run, so batch jobs cant change them
+    "HEADLESS_RENDERING", "DRY_RUN", "BATCH_JOBS", "BATCH_WORKERS",
+    "CITY_LABEL_FONT_NAME", "CITY_LABEL_FONT_SIZE", "CITY_LABEL_UPPERCASE", "ROUTE_LABEL_FONT_NAME", "ROUTE_LABEL_FONT_SIZE",
+    "MAPS_DIR", "RENDER_MANIFEST", "DATA_DIR", "GEOMETRY_DIR", "ROUTES_CSV", "CITIES_CSV", "OPERATOR_COLORS_CSV", "ROUTE_TABLE", "GEOMETRY_INDEX", "GEOMETRY_PACK",
+    "UPDATE_ROUTES", "UPDATE_GEOMETRY", "UPDATE_DATA", "OUTPUT_NAME",
+}
 
-    if CITY_LABEL_FONT_NAME:
-        city_font = ImageFont.truetype(CITY_LABEL_FONT_NAME, CITY_LABEL_FONT_SIZE)
-    else:
-        city_font = ImageFont.truetype(default_font_path, CITY_LABEL_FONT_SIZE)
+init(autoreset=True)  # for colorama, this MSUT only be run once
 
-    if ROUTE_LABEL_FONT_NAME:
-        route_font = ImageFont.truetype(ROUTE_LABEL_FONT_NAME, ROUTE_LABEL_FONT_SIZE)
-    else:
-        route_font = ImageFont.truetype(default_font_path, ROUTE_LABEL_FONT_SIZE)
+@lru_cache(maxsize=2)
+def load_fonts(headless):  # (city font, route font) for pillow or pygame, loaded the first time a label is drawn because finding system fonts is slow
+    if headless:
+        pygame_dir = importlib.util.find_spec("pygame").submodule_search_locations[0]  # without importing pygame
+        default_font_path = os.path.join(pygame_dir, "freesansbold.ttf") # use the pygame default font even in headless mode for consistency
+        return (
+            ImageFont.truetype(CITY_LABEL_FONT_NAME or default_font_path, CITY_LABEL_FONT_SIZE),
+            ImageFont.truetype(ROUTE_LABEL_FONT_NAME or default_font_path, ROUTE_LABEL_FONT_SIZE),
+        )
+    pygame.font.init()
+    return (
+        pygame.font.SysFont(CITY_LABEL_FONT_NAME, CITY_LABEL_FONT_SIZE),
+        pygame.font.SysFont(ROUTE_LABEL_FONT_NAME, ROUTE_LABEL_FONT_SIZE),
+    )
 
-    CITY_LABEL_FONT_SIZE = CITY_LABEL_FONT_SIZE - 7 # not a perfect conversion, but works well for size 20
-    ROUTE_LABEL_FONT_SIZE = ROUTE_LABEL_FONT_SIZE - 7
-else:
-    city_font = pygame.font.SysFont(CITY_LABEL_FONT_NAME, CITY_LABEL_FONT_SIZE)
-    route_font = pygame.font.SysFont(ROUTE_LABEL_FONT_NAME, ROUTE_LABEL_FONT_SIZE)
 
 
 def meters_per_degree(lat):
@@ -231,6 +366,25 @@ def segment_too_long(route, m_per_deg_lat, m_per_deg_lon):
                 return True
     return False
 
+def geo_to_pixel_array(line, origin_lon, origin_lat, m_per_deg_lat, m_per_deg_lon, SCALE_M_PER_PX):
+    # geo_to_pixel for a whole (vertices, 2) array of lon, lat at once, rounds exactly the same way as round() (half to even)
+    dx = (line[:, 0] - origin_lon) * m_per_deg_lon
+    dy = (origin_lat - line[:, 1]) * m_per_deg_lat
+    return np.column_stack((np.rint(dx / SCALE_M_PER_PX), np.rint(dy / SCALE_M_PER_PX))).astype(np.int64)
+
+def max_segment_length(route, m_per_deg_lat, m_per_deg_lon):  # length in meters of the longest segment in any line of the route
+    longest = 0.0
+    for line in route:
+        if len(line) < 2:
+            continue
+        dx = (line[1:, 0] - line[:-1, 0]) * m_per_deg_lon
+        dy = (line[1:, 1] - line[:-1, 1]) * m_per_deg_lat
+        longest = max(longest, (dx * dx + dy * dy).max())  # sqrt is only needed for the longest one
+    return sqrt(longest)
+
+def segment_too_long_array(route, m_per_deg_lat, m_per_deg_lon):  # segment_too_long for routes made of arrays
+    return max_segment_length(route, m_per_deg_lat, m_per_deg_lon) > MAX_LINE_LENGTH_METERS
+
 def bbox_diagonal_distance(bbox, m_per_deg_lat, m_per_deg_lon):
     min_lon, min_lat, max_lon, max_lat = bbox
     dx = (max_lon - min_lon) * m_per_deg_lon
@@ -249,7 +403,8 @@ def get_operator_color(operator, operator_colors):
         operator, operator_colors.get("DEFAULT", (255, 255, 255))
     )
 
-def load_operator_colors(path):
+@lru_cache(maxsize=1)
+def load_operator_colors(path):  # only read once however many maps are drawn
     operator_colors = {}
     if not os.path.isfile(path):
         print(f"Warning: {path} not found, using fallback white.")
@@ -282,160 +437,344 @@ def scale_color(color, target_brightness):
     )
     return scaled
 
-def draw_city_labels(screen, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):
-    if not DRAW_CITY_LABELS:
-        return
-
-    if not os.path.isfile(CITIES_CSV):
-        print(f"{CITIES_CSV} not found!")
-        return
-
-    font = pygame.font.SysFont(CITY_LABEL_FONT_NAME, CITY_LABEL_FONT_SIZE)
-
-    with open(CITIES_CSV, newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
+@lru_cache(maxsize=1)
+def load_cities(path):  # [(name, lon, lat)], only read once however many maps are drawn
+    cities = []
+    with open(path, newline="", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
             try:
                 name = row["name"]
                 if CITY_LABEL_UPPERCASE:
                     name = name.upper()
+                cities.append((name, float(row["longitude"]), float(row["latitude"])))
+            except Exception as e:
+                print(f"Failed to load city {row.get('name', '?')}: {e}")
+    return cities
 
-                lon = float(row["longitude"])
-                lat = float(row["latitude"])
-                x, y = geo_to_pixel(
-                    lon,
-                    lat,
-                    min_lon,
-                    max_lat,
-                    m_per_deg_lat,
-                    m_per_deg_lon,
-                    SCALE_M_PER_PX,
-                )
+@lru_cache(maxsize=LABEL_SPRITE_CACHE_SIZE)
+def text_size(text, font):  # (width, height) of text, pillow sizes are measured from the glyphs like textbbox does
+    if HEADLESS_RENDERING:
+        bbox = font.getbbox(text)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+    return font.size(text)
 
-                if HEADLESS_RENDERING:
-                    bbox = city_font.getbbox(name)
-                    text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+def label_margin(box_style):  # room around a headless label's text for its box and any glyphs that hang outside their bbox
+    _, padding, box_width, _, _ = box_style
+    return padding + box_width + 4
 
-                    text_x = x - text_width // 2
-                    text_y = y - text_height // 2
+@lru_cache(maxsize=LABEL_SPRITE_CACHE_SIZE)
+def label_sprite(text, color, font, height, box_style):  # label rendered once with its box, returns (sprite, margin around the text)
+    draw_box, padding, box_width, bg_color, alpha = box_style
 
-                    screen.text((text_x, text_y), name, font=city_font, fill=CITY_LABEL_COLOR + (CITY_LABEL_ALPHA,)) # screen is draw in this context
-                else:
-                    label_surface = city_font.render(name, True, CITY_LABEL_COLOR)
-                    label_surface.set_alpha(CITY_LABEL_ALPHA)
+    if HEADLESS_RENDERING:
+        text_width = text_size(text, font)[0]
+        margin = label_margin(box_style)
+        sprite = Image.new("RGBA", (text_width + margin * 2, height + margin * 2), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(sprite)
+        if draw_box:
+            half_width = box_width / 2
+            box = [
+                margin - padding + half_width,
+                margin - padding + half_width,
+                margin + text_width + padding - half_width,
+                margin + height + padding - half_width
+            ]
+            draw.rectangle(box, fill=bg_color, outline=color, width=box_width)
+        draw.text((margin, margin), text, font=font, fill=color + (alpha,))
+        return sprite, margin
+
+    label_surface = font.render(text, True, color)
+    label_surface.set_alpha(alpha)
+    if not draw_box:
+        return label_surface, 0
+
+    sprite = pygame.Surface(label_surface.get_rect().inflate(padding * 2, padding * 2).size)
+    sprite.fill(bg_color)
+    pygame.draw.rect(sprite, color, sprite.get_rect(), box_width)
+    sprite.blit(label_surface, (padding, padding))
+    return sprite, padding
+
+def draw_label(screen, text, color, font, text_x, text_y, height, box_style):  # draws a label with the top left of its text at text_x, text_y
+    draw_box, padding, box_width, bg_color, alpha = box_style
+
+    if HEADLESS_RENDERING and alpha < 255:  # pillow doesnt blend transparent text, so it cant be drawn as a sprite without looking different
+        draw = ImageDraw.Draw(screen)
+        if draw_box:
+            text_width = text_size(text, font)[0]
+            half_width = box_width / 2
+            box = [
+                text_x - padding + half_width,
+                text_y - padding + half_width,
+                text_x + text_width + padding - half_width,
+                text_y + height + padding - half_width
+            ]
+            draw.rectangle(box, fill=bg_color, outline=color, width=box_width)
+        draw.text((text_x, text_y), text, font=font, fill=color + (alpha,))
+        return
+
+    sprite, margin = label_sprite(text, color, font, height, box_style)
+    x, y = text_x - margin, text_y - margin
+    if HEADLESS_RENDERING:
+        # alpha_composite cant take a box that starts off the canvas, so only the part of the sprite on it is drawn
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + sprite.width, screen.width), min(y + sprite.height, screen.height)
+        if left >= right or top >= bottom:
+            return  # none of the label is on the canvas
+        screen.alpha_composite(sprite, (left, top), (left - x, top - y, right - x, bottom - y))
+    else:
+        screen.blit(sprite, (x, y))
 
-                    # center the label
-                    text_rect = label_surface.get_rect(center=(x, y))
-                    screen.blit(label_surface, text_rect)
+def city_label_style():
+    return (False, 0, 0, None, CITY_LABEL_ALPHA)
 
-            except Exception as e:
-                print(f"Failed to render city {row.get('name', '?')}: {e}")
+def city_labels(min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):  # [(name, text x, text y, text height)] for every city, with the label centred on the city
+    city_font = load_fonts(HEADLESS_RENDERING)[0]
+    labels = []
+    for name, lon, lat in load_cities(CITIES_CSV):
+        try:
+            x, y = geo_to_pixel(
+                lon,
+                lat,
+                min_lon,
+                max_lat,
+                m_per_deg_lat,
+                m_per_deg_lon,
+                SCALE_M_PER_PX,
+            )
 
-def draw_route_labels(screen, labels, m_per_deg_lat, m_per_deg_lon):
-    if not DRAW_ROUTE_LABELS:
+            # center the label
+            text_width, text_height = text_size(name, city_font)
+            labels.append((name, x - text_width // 2, y - text_height // 2, text_height))
+
+        except Exception as e:
+            print(f"Failed to render city {name}: {e}")
+    return labels
+
+def draw_city_labels(screen, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, offset_y=0, labels=None):
+    # screen is the image in headless mode, offset_y is the map row at its top, labels is the output of city_labels if its already been worked out
+    if not DRAW_CITY_LABELS:
         return
 
-    for label in labels:
+    if labels is None:
+        if not os.path.isfile(CITIES_CSV):
+            print(f"{CITIES_CSV} not found!")
+            return
+        labels = city_labels(min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+
+    box_style = city_label_style()
+    city_font = load_fonts(HEADLESS_RENDERING)[0]
+    for name, text_x, text_y, text_height in labels:
         try:
-            text = label["routeNumber"]
-            points = label["points"]
+            draw_label(screen, name, CITY_LABEL_COLOR, city_font, text_x, text_y - offset_y, text_height, box_style)
+        except Exception as e:
+            print(f"Failed to render city {name}: {e}")
+
+def label_anchor(points, distances, fraction):  # pixel position the given fraction of the way along a line
+    target = distances[-1] * fraction
+    i = max(int(np.searchsorted(distances, target)), 1)  # first point at least target along the line
+    x1, y1 = points[i - 1]
+    x2, y2 = points[i]
+    if distances[i] <= distances[i - 1]:
+        return int(x1), int(y1)  # the line starts with repeated points and the target is right at its start
+    ratio = (target - distances[i - 1]) / (distances[i] - distances[i - 1])
+    return int(x1 + ratio * (x2 - x1)), int(y1 + ratio * (y2 - y1))
+
+def grid_cells(box, cell_size):
+    left, top, right, bottom = box
+    for x in range(floor(left / cell_size), floor(right / cell_size) + 1):
+        for y in range(floor(top / cell_size), floor(bottom / cell_size) + 1):
+            yield x, y
+
+def place_route_labels(labels, measure):  # works out where route labels go, returns (text, color, x, y) for each label to draw
+    # measure(text) returns the (width, height) of the text, so the same placement works for pygame and pillow
+    candidates = []
+    for label in labels:
+        text = label["routeNumber"]
+        if len(label["points"]) < 2 or len(text) > ROUTE_LABEL_MAX_LENGTH or text == "":
+            continue
+        points = np.array(label["points"], dtype=np.float64)
+        steps = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+        distances = np.concatenate(([0], np.cumsum(steps)))
+        if distances[-1] == 0:
+            continue
+        candidates.append((label, points, distances))
+
+    if not ROUTE_LABEL_AVOID_OVERLAP:
+        return [(label["routeNumber"], label["color"], *label_anchor(points, distances, 0.5)) for label, points, distances in candidates]
+
+    placed = []
+    occupied = defaultdict(list)  # grid cell: label boxes overlapping it
+    numbers = defaultdict(list)  # (route number, grid cell): label positions in it
+    dedupe_cell = max(ROUTE_LABEL_DEDUPE_DISTANCE, 1)
+    padding = ROUTE_LABEL_BOX_PADDING + ROUTE_LABEL_BOX_WIDTH
+
+    for label, points, distances in sorted(candidates, key=lambda candidate: -candidate[0].get("frequency", 0)):  # busiest first, ties stay in drawing order
+        text = label["routeNumber"]
+        x, y = label_anchor(points, distances, 0.5)
+        cell_x, cell_y = floor(x / dedupe_cell), floor(y / dedupe_cell)
+        nearby = (
+            position
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            for position in numbers[(text, cell_x + dx, cell_y + dy)]
+        )
+        if any((x - px) ** 2 + (y - py) ** 2 < ROUTE_LABEL_DEDUPE_DISTANCE ** 2 for px, py in nearby):
+            continue  # the same route number is already labelled close by, probably the other direction or another operator on the same corridor
+
+        width, height = measure(text)
+        for fraction in ROUTE_LABEL_POSITIONS:
+            x, y = label_anchor(points, distances, fraction)
+            left, top = x - width // 2 - padding, y - height // 2 - padding
+            box = (left, top, left + width + padding * 2, top + height + padding * 2)
+            cells = list(grid_cells(box, LABEL_GRID_SIZE))
+            if not any(
+                box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+                for cell in cells for other in occupied[cell]
+            ):
+                break
+        else:
+            continue  # no room anywhere along the route
 
-            if OVERRIDE_ROUTE_LABEL_COLOR:
-                color = ROUTE_LABEL_COLOR
-            else:
-                color = label["color"]
+        for cell in cells:
+            occupied[cell].append(box)
+        numbers[(text, floor(x / dedupe_cell), floor(y / dedupe_cell))].append((x, y))
+        placed.append((text, label["color"], x, y))
 
-            if len(points) < 2:
-                continue
+    run_report.count("route labels placed", len(placed))
+    run_report.count("route labels left out", len(labels) - len(placed))
+    return placed
 
-            if len(text) > ROUTE_LABEL_MAX_LENGTH or text == "":
-                continue
+def measure_route_label(text):  # (width, height) of a route label's text, the height is the same for every label in headless mode
+    route_font = load_fonts(HEADLESS_RENDERING)[1]
+    if HEADLESS_RENDERING:
+        ascent, descent = route_font.getmetrics()
+        return text_size(text, route_font)[0], ascent + descent
+    return text_size(text, route_font)
 
-            distances = [0]
-            for i in range(1, len(points)):
-                x1, y1 = points[i - 1]
-                x2, y2 = points[i]
-                dist = sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-                distances.append(distances[-1] + dist)
+def draw_route_labels(screen, labels, m_per_deg_lat, m_per_deg_lon, placed=None, offset_y=0):
+    # screen is the image in headless mode, placed is the output of place_route_labels if its already been worked out, offset_y is the map row at the top of screen
+    if not DRAW_ROUTE_LABELS:
+        return
 
-            total_dist = distances[-1]
-            if total_dist == 0:
-                continue
+    if placed is None:
+        placed = place_route_labels(labels, measure_route_label)
 
-            half_dist = total_dist / 2
-            for i in range(1, len(distances)):
-                if distances[i] >= half_dist:
-                    x1, y1 = points[i - 1]
-                    x2, y2 = points[i]
-                    ratio = (half_dist - distances[i - 1]) / (
-                        distances[i] - distances[i - 1]
-                    )
-                    label_x = int(x1 + ratio * (x2 - x1))
-                    label_y = int(y1 + ratio * (y2 - y1))
-                    break
-            else:
-                label_x, label_y = points[len(points) // 2]  # fallback
+    box_style = (DRAW_ROUTE_LABEL_BOX, ROUTE_LABEL_BOX_PADDING, ROUTE_LABEL_BOX_WIDTH, ROUTE_LABEL_BG_COLOR, ROUTE_LABEL_ALPHA)
+    route_font = load_fonts(HEADLESS_RENDERING)[1]
 
-            if HEADLESS_RENDERING:
-                ascent, descent = route_font.getmetrics()
-                font_height = ascent + descent
-                padding = ROUTE_LABEL_BOX_PADDING
-                box_height = font_height + padding * 2
-                bbox = screen.textbbox((0, 0), text, font=route_font)
-
-                text_width = bbox[2] - bbox[0]
-                text_x = label_x - text_width // 2
-                text_y = label_y - font_height // 2
-
-                if DRAW_ROUTE_LABEL_BOX:
-                    padding = ROUTE_LABEL_BOX_PADDING
-                    half_width = ROUTE_LABEL_BOX_WIDTH / 2
-
-                    box = [
-                        text_x - padding + half_width,
-                        text_y - padding + half_width,
-                        text_x + text_width + padding - half_width,
-                        text_y + font_height + padding - half_width
-                    ]
-                    screen.rectangle(box, fill=ROUTE_LABEL_BG_COLOR, outline=color, width=ROUTE_LABEL_BOX_WIDTH)
-
-                screen.text((text_x, text_y), text, font=route_font, fill=color + (ROUTE_LABEL_ALPHA,))
+    for text, color, label_x, label_y in placed:
+        try:
+            if OVERRIDE_ROUTE_LABEL_COLOR:
+                color = ROUTE_LABEL_COLOR
 
-            else:
-                label_surface = route_font.render(text, True, color)
-                label_surface.set_alpha(ROUTE_LABEL_ALPHA)
-                text_rect = label_surface.get_rect(center=(label_x, label_y))
+            text_width, text_height = measure_route_label(text)
+            draw_label(screen, text, color, route_font, label_x - text_width // 2, label_y - text_height // 2 - offset_y, text_height, box_style)
 
-                if DRAW_ROUTE_LABEL_BOX:
-                    padded_rect = text_rect.inflate(ROUTE_LABEL_BOX_PADDING * 2, ROUTE_LABEL_BOX_PADDING * 2)
-                    
-                    pygame.draw.rect(screen, ROUTE_LABEL_BG_COLOR, padded_rect)
-                    pygame.draw.rect(screen, color, padded_rect, ROUTE_LABEL_BOX_WIDTH)
+        except Exception as e:
+            print(f"Failed to draw label {text}: {e}")
+
+def print_label_cache_summary():
+    info = label_sprite.cache_info()
+    lookups = info.hits + info.misses
+    if lookups:
+        print(f"{Fore.CYAN}Label sprites: {Fore.YELLOW}{info.misses}{Fore.CYAN} rendered, {Fore.YELLOW}{info.hits}{Fore.CYAN} reused ({Fore.YELLOW}{info.hits / lookups:.0%}{Fore.CYAN} hit rate)\n")
+
+def peak_rss_mb():  # most memory this process has used at once so far, None where it cant be found
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024  # bytes on macos, kilobytes everywhere else
+
+class RunReport:  # where the time and memory of a run went, saved as json next to the output
+    def __init__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.timers = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.failures = defaultdict(list)  # what couldnt be downloaded, by what it was
+        self.filter_stats = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):  # times the code inside a with block, phases shouldnt be nested or their memory peaks get mixed up
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"seconds": 0.0})
+            phase["seconds"] += time.perf_counter() - start
+            phase["peak_rss_mb"] = peak_rss_mb()
+            if tracemalloc.is_tracing():
+                phase["python_peak_mb"] = max(phase.get("python_peak_mb", 0), tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+
+    def time(self, name, seconds):  # for parts of a phase that are spread through it, like reading geometry while drawing
+        self.timers[name] += seconds
+
+    def count(self, name, amount=1):  # safe to call from multiple threads
+        with self.lock:
+            self.counts[name] += amount
+
+    def fail(self, name, item):  # safe to call from multiple threads
+        with self.lock:
+            self.failures[name].append(item)
+
+    def save(self, path, output):
+        report = {
+            "output": output,
+            "render_mode": RENDER_MODE,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "phases": self.phases,
+            "timers": dict(self.timers),
+            "counts": dict(self.counts),
+            "failures": {name: items for name, items in self.failures.items() if items},
+            "filters": {
+                reason: {"rejected": self.filter_stats.counts[reason], "seconds": self.filter_stats.seconds[reason]}
+                for reason, _ in TABLE_FILTERS + GEOMETRY_FILTERS if reason in self.filter_stats.counts
+            } if self.filter_stats else {},
+            "label_sprites": label_sprite.cache_info()._asdict(),
+        }
+        write_file_atomic(path, json.dumps(report, indent=1))
 
-                screen.blit(label_surface, text_rect)
+run_report = RunReport()  # replaced at the start of every run, counts from tile, band and batch worker processes arent included
 
-        except Exception as e:
-            print(f"Failed to draw label {label.get('routeNumber', '?')}: {e}")
+def report_phase(name):  # decorator that times every call of a function as a phase of the run report
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with run_report.phase(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
 
 def color_status(code):
     if code == 200:
         return Fore.GREEN + str(code) + Style.RESET_ALL
+    elif code == 304:
+        return Fore.CYAN + str(code) + Style.RESET_ALL
     elif code == 404:
         return Fore.RED + str(code) + Style.RESET_ALL
     else:
         return Fore.YELLOW + str(code) + Style.RESET_ALL
 
-def parse_service_page(r):
-    try:
-        soup = BeautifulSoup(r.text, "html.parser")
+def parse_page_script(html):
+    service_id_match = re.search(r"SERVICE_ID\s*=\s*(\d+);", html)
+    extent_match = re.search(r"EXTENT\s*=\s*(\[[^\]]+\]);", html)
 
-        service_id_match = re.search(r"SERVICE_ID\s*=\s*(\d+);", r.text)
-        extent_match = re.search(r"EXTENT\s*=\s*(\[[^\]]+\]);", r.text)
+    service_id = service_id_match.group(1) if service_id_match else ""
+    extent = (
+        extent_match.group(1) if extent_match else ""
+    )  # this data is in the route page in a script at the end, its pretty accurate too, very convenient!
+    return service_id, extent
 
-        service_id = service_id_match.group(1) if service_id_match else ""
-        extent = (
-            extent_match.group(1) if extent_match else ""
-        )  # this data is in the route page in a script at the end, its pretty accurate too, very convenient!
+def parse_service_page_soup(html):  # original parser, kept as the reference the fast parser is checked against
+    try:
+        soup = bs4.BeautifulSoup(html, "html.parser")
+
+        service_id, extent = parse_page_script(html)
 
         header = soup.find("h1", class_="service-header")
         route_elem = header.find("strong") if header else None
@@ -466,23 +805,85 @@ def parse_service_page(r):
 
     except Exception as e:
         print(f"\nFailed to parse page: {e}")
-        return None, 0
+        return None
+
+def has_class(name):  # xpath equivalent of BeautifulSoup's class_= matching
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+@lru_cache(maxsize=1)
+def page_xpaths():  # compiled the first time a page is parsed, so lxml isnt imported by runs that dont download
+    return {
+        "route_number": lxml_etree.XPath(f"(//h1[{has_class('service-header')}])[1]/descendant::strong[1]"),
+        "groupings": lxml_etree.XPath(f"//div[{has_class('grouping')}]"),
+        "first_row": lxml_etree.XPath(f"(.//table[{has_class('timetable')}])[1]/descendant::tr[1]"),
+        # BeautifulSoup's get_text() leaves out scripts, styles, templates and comments
+        "text": lxml_etree.XPath("//text()[not(ancestor::script or ancestor::style or ancestor::template)]"),
+    }
+
+def parse_service_page_lxml(html):  # same output as parse_service_page_soup, but lets lxml do all the work in C
+    root = lxml_html.fromstring(html)
+    xpaths = page_xpaths()
+
+    service_id, extent = parse_page_script(html)
+
+    route_elem = xpaths["route_number"](root)
+    route_number = route_elem[0].text_content().strip() if route_elem else ""
+
+    frequency = 0
+    for grouping in xpaths["groupings"](root):
+        first_row = xpaths["first_row"](grouping)
+        if first_row:
+            # count only <td> elements (time cells, not stop names)
+            frequency += len(first_row[0].findall(".//td"))
+
+    page_text = "".join(xpaths["text"](root)).lower()
+    is_public = not any(
+        keyword.lower() in page_text for keyword in PRIVATE_KEYWORDS
+    )
+
+    return {
+        "serviceID": service_id,
+        "extent": extent,
+        "routeNumber": route_number,
+        "frequency": frequency,
+        "isPublicService": is_public,
+    }
+
+def parse_service_page(html):  # takes the page text rather than the response so it can be sent to a parser process
+    if FAST_PAGE_PARSER:
+        try:
+            return parse_service_page_lxml(html)
+        except Exception:
+            pass  # anything lxml cant handle (e.g. an empty page) is parsed the slow way
+    return parse_service_page_soup(html)
+
+ROUTES_FIELDNAMES = [
+    "serviceID",
+    "extent",
+    "routeNumber",
+    "frequency",
+    "isPublicService",
+    "mode",
+    "operator",
+]
 
+@report_phase("download routes")
 def download_routes():  # uses both bustimes.org API data and scraped data, because neither has all the data needed
     print(f"{Fore.GREEN}Downloading Routes")
 
-    status_history = []  # for the fancy status code display
+    session = make_session(SCRAPE_FETCH_WORKERS)
+    rate_limiter = RateLimiter(DOWNLOAD_RATE_LIMIT)
 
     # fetch URLs from the sitemap
-    response = requests.get(SERVICES_SITEMAP_URL, headers=HEADERS)
+    response = fetch(session, SERVICES_SITEMAP_URL, rate_limiter)
     response.raise_for_status()
-    soup = BeautifulSoup(response.content, "xml")
+    soup = bs4.BeautifulSoup(response.content, "xml")
     service_urls = [loc.text for loc in soup.find_all("loc")]
     print(f"{Fore.GREEN}Found {len(service_urls)} route URLs")
 
     # fetch the big json file
     print(f"{Fore.GREEN}Downloading services.json from bustimes.org")
-    json_data = requests.get(SERVICES_JSON_URL, headers=HEADERS).json()["results"]
+    json_data = fetch(session, SERVICES_JSON_URL, rate_limiter).json()["results"]
     json_lookup = {
         str(entry["id"]): {
             "mode": entry.get("mode", ""),
@@ -491,72 +892,117 @@ def download_routes():  # uses both bustimes.org API data and scraped data, beca
         for entry in json_data
     }
 
-    all_data = []
-
     print(f"{Fore.GREEN}Scraping route data from bustimes.org:")
 
-    scrape_counter = 0
+    if SERVICE_PAGES_DIR:
+        os.makedirs(SERVICE_PAGES_DIR, exist_ok=True)
 
-    try:
-        for i, url in enumerate(service_urls, 1):
-            route_slug = url.rsplit("/", 1)[-1]
+    # pages are fetched on SCRAPE_FETCH_WORKERS threads and parsed on SCRAPE_PARSE_WORKERS processes,
+    # the bounded queue stops the fetchers running too far ahead of the parsers
+    parse_pool = None
+    if SCRAPE_PARSE_WORKERS:
+        parse_pool = ProcessPoolExecutor(SCRAPE_PARSE_WORKERS)
+        parse_pool.submit(int).result()  # start the parser processes now, before any fetcher threads exist to be forked
+    pending = queue.Queue(maxsize=SCRAPE_QUEUE_SIZE)
 
-            if FORCE_ROUTE_DATE:
-                url = f"{url}{ROUTE_DATE}"
+    def fetch_page(item):
+        order, url = item
+        route_slug = url.rsplit("/", 1)[-1]
 
-            r = requests.get(url, headers=HEADERS)
+        if FORCE_ROUTE_DATE:
+            url = f"{url}{ROUTE_DATE}"
+
+        try:
+            r = fetch(session, url, rate_limiter)
             code = r.status_code
-            status_history.append(code)
-            if len(status_history) > 10:
-                status_history.pop(0)
-
-            data = parse_service_page(r)
-            if data:
-                service_id = str(data["serviceID"])
-                if service_id in json_lookup:
-                    data["mode"] = json_lookup[service_id]["mode"]
-                    data["operator"] = ",".join(json_lookup[service_id]["operator"])
-                else:
-                    data["mode"] = ""
-                    data["operator"] = ""
-                all_data.append(data)
+            if SERVICE_PAGES_DIR:
+                write_file_atomic(os.path.join(SERVICE_PAGES_DIR, f"{route_slug}.html"), r.text)
+            if parse_pool:
+                data = parse_pool.submit(parse_service_page, r.text)
+            else:
+                data = parse_service_page(r.text)
+        except requests.RequestException:
+            code = "ERR"
+            data = None
 
-            colored_statuses = " ".join(color_status(c) for c in status_history)
-            sys.stdout.write(
-                f"\r\033[K{Fore.CYAN}Status: {colored_statuses} {Fore.CYAN}| {Fore.YELLOW}{i}{Fore.CYAN}/{Fore.GREEN}{len(service_urls)} {Fore.CYAN}| Requesting route: {Fore.YELLOW}{route_slug:<25}"
-            )
-            sys.stdout.flush()
+        if retryable(code):
+            run_report.fail("route pages", route_slug)
+        pending.put((order, route_slug, code, data))
 
-            scrape_counter += 1
-            # time.sleep(0.5) # be polite to the server
-    except Exception as e:
-        print(f"\n{Fore.RED}Error scraping {route_slug:<25} - {e}")
+    def fetch_pages():
+        try:
+            for (order, url), error in run_in_threads(fetch_page, enumerate(service_urls), SCRAPE_FETCH_WORKERS):
+                run_report.fail("route pages", f"{url.rsplit('/', 1)[-1]} ({type(error).__name__}: {error})")
+        finally:
+            pending.put(None)  # tells the writer there are no more pages coming
+
+    fetcher = threading.Thread(target=fetch_pages, daemon=True)
+    fetcher.start()
+
+    # rows are saved as soon as they arrive, then sorted into ROUTES_CSV once everything has been scraped
+    status = StatusLine(len(service_urls), "Requesting route")
+    partial_csv = ROUTES_CSV + ".part"
+    scrape_counter = 0
+    route_slug = ""
+
+    with open(partial_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=ROUTES_FIELDNAMES + ["order"])
+        writer.writeheader()
+
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                order, route_slug, code, data = item
+
+                if isinstance(data, Future):
+                    data = data.result()
+
+                if data:
+                    service_id = str(data["serviceID"])
+                    if service_id in json_lookup:
+                        data["mode"] = json_lookup[service_id]["mode"]
+                        data["operator"] = ",".join(json_lookup[service_id]["operator"])
+                    else:
+                        data["mode"] = ""
+                        data["operator"] = ""
+                    data["order"] = order
+                    writer.writerow(data)
+                    f.flush()
+                    scrape_counter += 1
+
+                status.update(code, route_slug)
+        except Exception as e:
+            print(f"\n{Fore.RED}Error scraping {route_slug:<25} - {e}")
+
+    if parse_pool:
+        parse_pool.shutdown(cancel_futures=True)
+    session.close()
 
     print(
         f"\n{Fore.GREEN}Successfully scraped {scrape_counter} routes from bustimes.org"
     )
+    print_download_failures("route pages", run_report.failures["route pages"])
 
-    # sort by frequency
-    all_data.sort(key=lambda x: x["frequency"])
+    # sort by frequency, ties stay in sitemap order so the output doesnt depend on which page arrived first
+    with open(partial_csv, newline="", encoding="utf-8") as f:
+        all_data = list(csv.DictReader(f))
+    all_data.sort(key=lambda x: (int(x["frequency"]), int(x["order"])))
 
     # write csv
-    fieldnames = [
-        "serviceID",
-        "extent",
-        "routeNumber",
-        "frequency",
-        "isPublicService",
-        "mode",
-        "operator",
-    ]
-
-    with open(ROUTES_CSV, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+    with open(ROUTES_CSV + ".tmp", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=ROUTES_FIELDNAMES, extrasaction="ignore")
         writer.writeheader()
         writer.writerows(all_data)
+    os.replace(ROUTES_CSV + ".tmp", ROUTES_CSV)
+    os.remove(partial_csv)
 
     print(f"{Fore.GREEN}Saved routes to {ROUTES_CSV}")
 
+    build_route_table()
+
+@report_phase("download operator colors")
 def download_colors():
     try:
         r = requests.get(OPERATOR_COLORS_URL, headers=HEADERS)
@@ -569,6 +1015,7 @@ def download_colors():
         print(f"{Fore.RED}Failed to download {OPERATOR_COLORS_CSV}: {e}")
         exit(1)
 
+@report_phase("download cities")
 def download_cities():
     try:
         r = requests.get(CITIES_URL, headers=HEADERS)
@@ -581,55 +1028,723 @@ def download_cities():
         print(f"{Fore.RED}Failed to download {OPERATOR_COLORS_CSV}: {e}")
         exit(1)
 
-def download_geometry(start):  # scrapes bustimes.org because its much easier to work with than the data in the bustimes.org trips API
-    # work out what the highest route ID is, this should be run after updaing routes.csv
-    with open(ROUTES_CSV, newline="") as f:
-        reader = csv.DictReader(f)
-        end = max(int(row["serviceID"]) for row in reader) + 10
+def make_session(pool_size=DOWNLOAD_WORKERS):  # keep-alive session shared between all download threads
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class RateLimiter:  # spaces out requests made from any number of threads so there are at most rate per second
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class StatusLine:  # the fancy status code display, safe to update from multiple threads
+    def __init__(self, total, label):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.codes = defaultdict(int)
+        self.history = deque(maxlen=10)
+        self.lock = threading.Lock()
+
+    def update(self, code, item):
+        with self.lock:
+            self.done += 1
+            self.codes[code] += 1
+            self.history.append(code)
+            colored_statuses = " ".join(color_status(c) for c in self.history)
+            sys.stdout.write(
+                f"\r\033[K{Fore.CYAN}Status: {colored_statuses} {Fore.CYAN}| {Fore.YELLOW}{self.done}{Fore.CYAN}/{Fore.GREEN}{self.total} {Fore.CYAN}| {self.label}: {Fore.YELLOW}{item:<25}"
+            )
+            sys.stdout.flush()
+
+class ProgressReporter:  # progress line for long loops, only redrawn every PROGRESS_INTERVAL however often it is updated
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.last_print = 0
+
+    def update(self, count, detail="", force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_print < PROGRESS_INTERVAL:
+            return
+        self.last_print = now
+        print(
+            f"{Fore.CYAN}{self.label} {Fore.YELLOW}{count}{Fore.CYAN}/{Fore.GREEN}{self.total} {Fore.CYAN}| {detail}          ",
+            end="\r",
+        )
+
+def retryable(code):  # status codes fetch tries again, "ERR" is a request that couldnt be made at all
+    return code == "ERR" or code == 429 or code >= 500
 
-    if start >= end:
+def fetch(session, url, rate_limiter, **kwargs):  # GET with retries, backs off on connection errors, 429 and 5xx responses
+    delay = DOWNLOAD_BACKOFF
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        rate_limiter.wait()
+        run_report.count("http requests")
+        if attempt:
+            run_report.count("http retries")
+        try:
+            r = session.get(url, **kwargs)
+        except requests.RequestException:
+            if attempt == DOWNLOAD_RETRIES:
+                run_report.count("http requests failed")
+                raise
+        else:
+            if not retryable(r.status_code):
+                return r
+            if attempt == DOWNLOAD_RETRIES:
+                run_report.count("http requests failed")
+                return r
+            retry_after = r.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        time.sleep(delay)
+        delay *= 2
+
+def run_in_threads(work, items, workers):  # calls work(item) for every item using a fixed number of threads, returns [(item, exception)] for calls that raised
+    items = iter(items)
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                item = next(items, None)
+            if item is None:
+                return
+            try:
+                work(item)
+            except Exception as e:  # one bad item shouldnt stop this thread working through the rest
+                with lock:
+                    errors.append((item, e))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)  # join with a timeout so ctrl+c still works
+    except KeyboardInterrupt:
+        stop.set()
+        raise
+    return errors
+
+def print_download_failures(label, failed):  # summary of what still couldnt be downloaded once every retry was used up
+    if not failed:
+        return
+    shown = ", ".join(str(item) for item in failed[:10]) + (f" and {len(failed) - 10} more" if len(failed) > 10 else "")
+    print(f"{Fore.RED}{len(failed)} {label} failed after {DOWNLOAD_RETRIES} retries {Fore.WHITE}- {Fore.YELLOW}{shown}")
+
+def write_file_atomic(path, content):  # write to a temporary file first so a partly written file is never left behind
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def geometry_file_entry(content, fetched):  # the parts of a geometry index entry that describe the file itself
+    return {"fetched": fetched, "size": len(content), "checksum": zlib.crc32(content)}
+
+def sync_geometry_index(index):  # adds geometry files the downloaders didnt write (extracted from the zip, copied in) and forgets ones that have been deleted
+    stored = set()
+    for filename in os.listdir(GEOMETRY_DIR):
+        if filename.lower().endswith(".json"):
+            name_part = os.path.splitext(filename)[0]
+            if name_part.isdigit():
+                stored.add(int(name_part))
+
+    for service_id in set(index) - stored:
+        del index[service_id]
+    for service_id in stored - set(index):
+        path = os.path.join(GEOMETRY_DIR, f"{service_id}.json")
+        mtime = os.path.getmtime(path)
+        with open(path, "rb") as f:
+            index[service_id] = geometry_file_entry(f.read(), mtime)
+        # no headers were saved for it, so it is rechecked as changed since the file was written, unchanged routes get a 304 instead of a full download
+        index[service_id]["last_modified"] = formatdate(mtime, usegmt=True)
+    return index
+
+def load_geometry_index():  # {service ID: {"etag", "last_modified", "fetched", "extent", "size", "checksum"}} for every geometry file in GEOMETRY_DIR
+    index = None
+    if os.path.isfile(GEOMETRY_INDEX):
+        try:
+            with open(GEOMETRY_INDEX, encoding="utf-8") as f:
+                index = {int(service_id): entry for service_id, entry in json.load(f).items()}
+        except Exception as e:
+            print(f"{Fore.YELLOW}Failed to read {GEOMETRY_INDEX}, it will be rebuilt from {GEOMETRY_DIR}: {e}")
+
+    # the downloaders save the index after changing the folder, so the folder is only listed if something else has changed it
+    if os.path.isdir(GEOMETRY_DIR) and (index is None or os.path.getmtime(GEOMETRY_DIR) > os.path.getmtime(GEOMETRY_INDEX)):
+        index = sync_geometry_index(index or {})
+        save_geometry_index(index)
+    return index or {}
+
+def save_geometry_index(index):
+    write_file_atomic(GEOMETRY_INDEX, json.dumps({str(service_id): entry for service_id, entry in sorted(index.items())}))
+    loaded_data["geometry_ids"] = set(index)
+
+def load_geometry_ids():  # service IDs that have a geometry file, from the geometry index so GEOMETRY_DIR isnt listed or checked one file at a time
+    service_ids = loaded_data.get("geometry_ids")
+    if service_ids is None:
+        service_ids = loaded_data["geometry_ids"] = set(load_geometry_index())
+    return service_ids
+
+def geometry_to_download(index):  # works out which routes in routes.csv have no geometry yet, and which have geometry that might be out of date
+    route_extents = {}
+    with open(ROUTES_CSV, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row["serviceID"].isdigit():
+                route_extents[int(row["serviceID"])] = row["extent"]
+
+    stored = set(index)
+    missing = set(route_extents) - stored
+    stale = set()
+    now = time.time()
+
+    for service_id in stored & set(route_extents):
+        entry = index[service_id]
+        if entry.get("extent") is None:
+            # downloaded before the index existed (or extracted from the zip), trust it until it gets old
+            entry["extent"] = route_extents[service_id]
+        if not entry.get("etag") and not entry.get("last_modified") and entry.get("fetched"):
+            entry["last_modified"] = formatdate(entry["fetched"], usegmt=True)  # no headers saved for it, the time it was fetched works as well
+
+        if entry.get("extent") != route_extents[service_id]:  # the route has changed since its geometry was downloaded
+            stale.add(service_id)
+        elif now - entry.get("fetched", 0) > GEOMETRY_MAX_AGE_DAYS * 86400:
+            stale.add(service_id)
+
+    return sorted(missing), sorted(stale), route_extents
+
+@report_phase("download geometry")
+def download_geometry():  # scrapes bustimes.org because its much easier to work with than the data in the bustimes.org trips API
+    # only routes listed in routes.csv are requested, this should be run after updaing routes.csv
+    index = load_geometry_index()
+    missing, stale, route_extents = geometry_to_download(index)
+
+    if not missing and not stale:
+        save_geometry_index(index)
         print(f"{Fore.GREEN}Geometry already up to date.")
         return
 
     print(
-        f"{Fore.GREEN}Downloading geometry for routes {Fore.CYAN}{start}{Fore.GREEN}-{Fore.CYAN}{end}"
+        f"{Fore.GREEN}Downloading geometry for {Fore.CYAN}{len(missing)}{Fore.GREEN} new routes and rechecking {Fore.CYAN}{len(stale)}{Fore.GREEN} existing routes"
     )
 
-    status_history = []  # for the fancy status code display
+    session = make_session()
+    rate_limiter = RateLimiter(DOWNLOAD_RATE_LIMIT)
+    status = StatusLine(len(missing) + len(stale), "Requesting geometry")
+    index_lock = threading.Lock()
 
-    for route_id in range(start, end):
+    def download(route_id):
         url = GEOMETRY_BASE_URL.format(route_id)
+        headers = {}
+        entry = index.get(route_id, {})
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
         try:
-            r = requests.get(url, headers=HEADERS, timeout=5)
+            r = fetch(session, url, rate_limiter, headers=headers, timeout=5)
             code = r.status_code
-            status_history.append(code)
-            if len(status_history) > 10:
-                status_history.pop(0)
 
             if code == 200 and r.headers.get("Content-Type", "").startswith(
                 "application/json"
             ):
-                with open(
-                    os.path.join(GEOMETRY_DIR, f"{route_id}.json"),
-                    "w",
-                    encoding="utf-8",
-                ) as f:
-                    f.write(r.text)
+                write_file_atomic(os.path.join(GEOMETRY_DIR, f"{route_id}.json"), r.text)
+                with index_lock:
+                    index[route_id] = {
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                        "extent": route_extents[route_id],
+                        **geometry_file_entry(r.text.encode("utf-8"), time.time()),
+                    }
+            elif code == 304:  # not changed since we last downloaded it
+                with index_lock:
+                    index[route_id] = dict(entry, fetched=time.time(), extent=route_extents[route_id])
 
         except requests.RequestException:
             code = "ERR"
-            status_history.append(code)
-            if len(status_history) > 10:
-                status_history.pop(0)
-
-        # fancy status display
-        colored_statuses = " ".join(color_status(c) for c in status_history)
-        sys.stdout.write(
-            f"\r{Fore.CYAN}Status: {colored_statuses} {Fore.CYAN}| Requesting geometry: {Fore.YELLOW}{route_id:<7}          "
-        )
-        sys.stdout.flush()
+
+        if retryable(code):
+            run_report.fail("geometry", route_id)
+        status.update(code, route_id)
+
+    try:
+        for route_id, error in run_in_threads(download, missing + stale, DOWNLOAD_WORKERS):
+            run_report.fail("geometry", f"{route_id} ({type(error).__name__}: {error})")
+    finally:
+        with index_lock:
+            save_geometry_index(index)  # saved even if interrupted so finished downloads are not repeated
+        session.close()
 
     print(f"\n{Fore.GREEN}Finished downloading geometry.")
+    print_download_failures("geometry downloads", run_report.failures["geometry"])
+
+def read_geometry_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+        run_report.count("geometry bytes read", f.tell())
+
+    geometry = data.get("geometry", {})
+    geom_type = geometry.get("type")
+    coords = geometry.get("coordinates")
+
+    if geom_type == "LineString":
+        lines = [coords]  # wrap in list to reuse same logic as MultiLineString
+    elif geom_type == "MultiLineString":
+        lines = coords
+    else:
+        return geom_type, []
+
+    return geom_type, lines
+
+def line_array(line):  # (vertices, 2) array of lon, lat from a GeoJSON line, any heights after them are dropped
+    line = np.array(line, dtype=np.float64)
+    if line.size == 0:
+        return line.reshape(0, 2)
+    if line.ndim != 2 or line.shape[1] < 2:
+        raise ValueError(f"points should be [lon, lat], got shape {line.shape}")
+    return np.ascontiguousarray(line[:, :2])
+
+def simplify_line(line, tolerance_m):  # Douglas-Peucker, line is a (vertices, 2) array of lon, lat, the first and last points are always kept
+    if tolerance_m <= 0 or len(line) < 3:
+        return line
+
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree(float(line[:, 1].mean()))
+    points = line * (m_per_deg_lon, m_per_deg_lat)
+    keep = np.zeros(len(line), dtype=bool)
+    keep[[0, -1]] = True
+
+    stack = [(0, len(line) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        direction = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = sqrt(direction[0] ** 2 + direction[1] ** 2)
+        if length:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        else:
+            distances = np.sqrt((offsets ** 2).sum(axis=1))  # line ends where it started
+        furthest = int(distances.argmax())
+        if distances[furthest] > tolerance_m:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+
+    return line[keep]
+
+def lod_level(scale_m_per_px):  # the most simplified level of GEOMETRY_PACK that is off by less than half a pixel at this scale
+    level = 0
+    for i, tolerance_m in enumerate(GEOMETRY_LOD_TOLERANCES, 1):
+        if tolerance_m <= scale_m_per_px / 2:
+            level = i
+    return level
+
+@report_phase("pack geometry")
+def pack_geometry():  # compacts every json file in GEOMETRY_DIR into GEOMETRY_PACK so it can be memory mapped instead of parsed
+    service_ids = sorted(load_geometry_ids())
+
+    print(f"{Fore.GREEN}Packing geometry for {Fore.CYAN}{len(service_ids)}{Fore.GREEN} routes into {Fore.YELLOW}{GEOMETRY_PACK}")
+
+    temp_path = GEOMETRY_PACK + ".tmp"
+    index = []
+    failed = 0
+
+    with open(temp_path, "wb") as f:
+        tolerances = [0] + list(GEOMETRY_LOD_TOLERANCES)
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0, len(tolerances)))
+        f.write(struct.pack(f"<{len(tolerances)}d", *tolerances))
+        f.write(b"\0" * (PACK_INDEX_ENTRY.size * len(service_ids)))  # filled in once all the blocks are written
+
+        for i, service_id in enumerate(service_ids, 1):
+            try:
+                geom_type, lines = read_geometry_file(os.path.join(GEOMETRY_DIR, f"{service_id}.json"))
+                lines = [line_array(line) for line in lines]
+            except Exception:
+                geom_type, lines = None, []  # unreadable files are treated the same as invalid line data
+                failed += 1
+
+            if geom_type not in PACK_GEOMETRY_TYPES:
+                geom_type, lines = None, []
+
+            f.write(b"\0" * (-f.tell() % 8))  # keep the coordinates 8 byte aligned
+            block_offset = f.tell()
+            index.append((service_id, PACK_GEOMETRY_TYPES.index(geom_type), block_offset))
+            f.write(b"\0" * (8 * len(tolerances)))  # level offsets, filled in once the levels are written
+
+            level_offsets = []
+            for tolerance_m in tolerances:
+                f.write(b"\0" * (-f.tell() % 8))
+                level_offsets.append(f.tell())
+                level_lines = [simplify_line(line, tolerance_m) for line in lines]
+                f.write(struct.pack(f"<{len(level_lines) + 1}I", len(level_lines), *(len(line) for line in level_lines)))
+                f.write(b"\0" * (-f.tell() % 8))
+                for line in level_lines:
+                    f.write(line.astype("<f8").tobytes())
+
+            end = f.tell()
+            f.seek(block_offset)
+            f.write(struct.pack(f"<{len(tolerances)}Q", *level_offsets))
+            f.seek(end)
+
+            if i % 500 == 0 or i == len(service_ids):
+                sys.stdout.write(f"\r{Fore.CYAN}Packing geometry: {Fore.YELLOW}{i}{Fore.CYAN}/{Fore.GREEN}{len(service_ids)}")
+                sys.stdout.flush()
+
+        f.seek(0)
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(index), len(tolerances)))
+        f.seek(PACK_HEADER.size + 8 * len(tolerances))
+        for entry in index:
+            f.write(PACK_INDEX_ENTRY.pack(*entry))
+
+    os.replace(temp_path, GEOMETRY_PACK)  # only replace the old pack once the new one is complete
+
+    if failed:
+        print(f"\n{Fore.YELLOW}{failed} geometry files could not be read and were packed as invalid line data")
+    print(f"\n{Fore.GREEN}Finished packing geometry.")
+
+def geometry_pack_outdated():
+    if not os.path.isfile(GEOMETRY_PACK):
+        return True
+    if os.path.getmtime(GEOMETRY_DIR) > os.path.getmtime(GEOMETRY_PACK):  # a file was added to or removed from the geometry folder
+        return True
+    with open(GEOMETRY_PACK, "rb") as f:
+        magic, version, count, levels = PACK_HEADER.unpack(f.read(PACK_HEADER.size))
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            return True
+        tolerances = list(struct.unpack(f"<{levels}d", f.read(8 * levels)))
+    return tolerances != [0] + list(GEOMETRY_LOD_TOLERANCES)  # levels of detail have been changed
+
+class GeometryStore:  # read only view of GEOMETRY_PACK, coordinates are sliced straight out of the memory map without copying
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, levels = PACK_HEADER.unpack_from(self.data, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(f"{path} is not a version {PACK_VERSION} geometry pack")
+        self.tolerances = struct.unpack_from(f"<{levels}d", self.data, PACK_HEADER.size)  # meters, level 0 is the original geometry
+
+        self.index = {}
+        index_start = PACK_HEADER.size + 8 * levels
+        index_end = index_start + PACK_INDEX_ENTRY.size * count
+        for service_id, geom_type, offset in PACK_INDEX_ENTRY.iter_unpack(self.data[index_start:index_end]):
+            self.index[service_id] = (geom_type, offset)
+
+    def __contains__(self, service_id):
+        return int(service_id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, service_id, level=0):  # returns (geometry type, [line, ...]) where each line is a (vertices, 2) array backed by the memory map, or None if missing
+        entry = self.index.get(int(service_id))
+        if entry is None:
+            return None
+
+        geom_type, offset = entry
+        level = min(level, len(self.tolerances) - 1)
+        (offset,) = struct.unpack_from("<Q", self.data, offset + 8 * level)
+        (line_count,) = struct.unpack_from("<I", self.data, offset)
+        vertex_counts = struct.unpack_from(f"<{line_count}I", self.data, offset + 4)
+
+        position = offset + 4 * (line_count + 1)
+        position += -position % 8
+        lines = []
+        for vertex_count in vertex_counts:
+            lines.append(np.frombuffer(self.data, dtype="<f8", count=vertex_count * 2, offset=position).reshape(vertex_count, 2))
+            position += vertex_count * 16
+
+        run_report.count("geometry bytes read", position - offset)
+        return PACK_GEOMETRY_TYPES[geom_type], lines
+
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            pass  # some lines are still in use, the map is closed when they are garbage collected instead
+        self.file.close()
+
+def open_geometry_store():
+    if not USE_GEOMETRY_PACK or not os.path.isfile(GEOMETRY_PACK):
+        return None
+    try:
+        return GeometryStore(GEOMETRY_PACK)
+    except Exception as e:
+        print(f"{Fore.RED}Failed to open {GEOMETRY_PACK}, falling back to {GEOMETRY_DIR}: {e}")
+        return None
+
+def load_route_geometry(service_id, geometry_store, level=0):  # returns (geometry type, list of (vertices, 2) arrays of lon, lat) or None if the route has no geometry
+    if geometry_store is not None:
+        return geometry_store.get(service_id, level)
+
+    if int(service_id) not in load_geometry_ids():
+        return None
+    try:
+        geom_type, lines = read_geometry_file(os.path.join(GEOMETRY_DIR, f"{service_id}.json"))
+        return geom_type, [line_array(line) for line in lines]
+    except FileNotFoundError:
+        return None  # deleted since the geometry index was saved
+    except (ValueError, TypeError):
+        return None, []  # unreadable files are treated the same as invalid line data, like pack_geometry does
+
+def build_route_table():  # compiles routes.csv into typed columns so filtering is done with array masks instead of per row python
+    # a timer not a phase, it can run inside the download routes and select routes phases
+    start = time.perf_counter()
+    print(f"{Fore.GREEN}Compiling {Fore.YELLOW}{ROUTES_CSV}")
+
+    service_ids = []
+    extents = []
+    frequencies = []
+    is_public = []
+    operator_codes = []
+    mode_codes = []
+    route_numbers = []
+    operators = {}  # interned operator/mode strings, the columns just store their position in these
+    modes = {}
+
+    with open(ROUTES_CSV, newline="", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            service_id = row.get("serviceID", "")
+            service_ids.append(int(service_id) if service_id.isdigit() else -1)
+
+            try:
+                extent = json.loads(row["extent"])
+                if len(extent) != 4 or not all(type(value) in (int, float) for value in extent):
+                    raise ValueError(extent)
+                extents.append(extent)
+            except Exception:
+                extents.append([nan, nan, nan, nan])  # picked up by the "Bad bounding box" filter
+
+            try:
+                frequencies.append(int(row["frequency"]))
+            except Exception:
+                frequencies.append(-1)  # picked up by the "Bad frequency" filter
+
+            is_public.append(row.get("isPublicService", "").lower() == "true")
+            operator_codes.append(operators.setdefault(row.get("operator", "").strip(), len(operators)))
+            mode_codes.append(modes.setdefault(row.get("mode", "").strip(), len(modes)))
+            route_numbers.append(row.get("routeNumber", ""))
+
+    stat = os.stat(ROUTES_CSV)
+    table = {
+        "meta": np.array([ROUTE_TABLE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+        "service_id": np.array(service_ids, dtype=np.int64),
+        "extent": np.array(extents, dtype=np.float64).reshape(-1, 4),
+        "frequency": np.array(frequencies, dtype=np.int64),
+        "is_public": np.array(is_public, dtype=bool),
+        "operator": np.array(operator_codes, dtype=np.int32),
+        "mode": np.array(mode_codes, dtype=np.int32),
+        "route_number": np.array(route_numbers, dtype=str),
+        "operators": np.array(list(operators), dtype=str),
+        "modes": np.array(list(modes), dtype=str),
+    }
+
+    temp_path = ROUTE_TABLE + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **table)
+    os.replace(temp_path, ROUTE_TABLE)
+
+    print(f"{Fore.GREEN}Compiled {Fore.CYAN}{len(service_ids)}{Fore.GREEN} routes into {Fore.YELLOW}{ROUTE_TABLE}")
+    run_report.time("compile route table", time.perf_counter() - start)
+    return table
+
+def route_table_outdated(table):
+    stat = os.stat(ROUTES_CSV)
+    version, size, mtime = table["meta"].tolist()
+    return version != ROUTE_TABLE_VERSION or size != stat.st_size or mtime != stat.st_mtime_ns
+
+loaded_data = {}  # route table and geometry IDs kept after they are first loaded, batch jobs forked from this process share them instead of loading their own
+
+def load_route_table():  # loads the compiled route table, rebuilding it first if routes.csv has changed
+    table = loaded_data.get("route_table")
+    if table is not None and not route_table_outdated(table):
+        return table
+    if os.path.isfile(ROUTE_TABLE):
+        try:
+            with np.load(ROUTE_TABLE) as data:
+                table = {name: data[name] for name in data.files}
+            if not route_table_outdated(table):
+                loaded_data["route_table"] = table
+                return table
+        except Exception as e:
+            print(f"{Fore.YELLOW}Failed to read {ROUTE_TABLE}: {e}")
+    table = build_route_table()
+    loaded_data["route_table"] = table
+    return table
+
+def get_style_table(frequencies):  # get_style_for_frequency for a whole array of frequencies at once
+    sorted_styles = sorted(ROUTE_STYLE_BY_FREQUENCY, key=lambda x: x[0])
+    thresholds = np.array([style[0] for style in sorted_styles])
+    style_index = np.minimum(np.searchsorted(thresholds, frequencies, side="left"), len(sorted_styles) - 1)
+    widths = np.array([style[1] for style in sorted_styles])[style_index]
+    brightnesses = np.array([style[2] for style in sorted_styles])[style_index]
+    return widths, brightnesses
+
+class FilterStats:  # how many routes each filter rejected and how long it spent checking them
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.last = "None filtered yet"
+
+    def add(self, reason, count, seconds):
+        self.counts[reason] += count
+        self.seconds[reason] += seconds
+        if count:
+            self.last = reason
+
+def per_name(names, codes, function):  # function applied once per distinct operator/mode rather than once per route
+    return np.array([function(name) for name in names] or [False])[codes]
+
+def outside_bbox(extent, bbox):
+    min_lon, min_lat, max_lon, max_lat = extent.T
+    bbox_min_lon, bbox_min_lat, bbox_max_lon, bbox_max_lat = bbox
+    return (max_lon < bbox_min_lon) | (min_lon > bbox_max_lon) | (max_lat < bbox_min_lat) | (min_lat > bbox_max_lat)
+
+# filters are checked in order and each route is counted against the first filter it fails
+# route table filters work on whole columns at once so they all run before any geometry is read
+TABLE_FILTERS = [  # (reason, function of the route columns returning a mask of routes to reject, or None if the filter is turned off)
+    ("Route is public", lambda c: c["is_public"] if SHOW_ONLY_PRIVATE_ROUTES else None),
+    ("Route is private", lambda c: ~c["is_public"] if IGNORE_PRIVATE_ROUTES and not SHOW_ONLY_PRIVATE_ROUTES else None),
+    ("Operator not included", lambda c: ~per_name(c["operators"], c["operator"], lambda op: op in INCLUDE_OPERATORS) if INCLUDE_OPERATORS else None),
+    ("Operator excluded", lambda c: per_name(c["operators"], c["operator"], lambda op: op in EXCLUDE_OPERATORS) if EXCLUDE_OPERATORS else None),
+    ("Mode not included", lambda c: ~per_name(c["modes"], c["mode"], lambda m: m in INCLUDE_MODES) if INCLUDE_MODES else None),
+    ("Mode excluded", lambda c: per_name(c["modes"], c["mode"], lambda m: m in EXCLUDE_MODES) if EXCLUDE_MODES else None),
+    ("Bad bounding box", lambda c: np.isnan(c["extent"]).any(axis=1)),
+    ("Out of bounding box", lambda c: outside_bbox(c["extent"], BOUNDING_BOX)),
+    ("Route too long", lambda c: c["diagonal"] > MAX_ROUTE_LENGTH),
+    ("Route too short", lambda c: c["diagonal"] < MIN_ROUTE_LENGTH),
+    ("Bad frequency", lambda c: c["frequency"] < 0),
+    ("Operator color set", lambda c: per_name(c["operators"], c["operator"], lambda op: get_operator_color(op, c["operator_colors"]) != (255, 255, 255)) if SHOW_ONLY_UNCOLORED else None),
+    ("Low frequency", lambda c: get_style_table(c["frequency"])[0] <= 0),
+]
+
+# geometry filters run one route at a time on the full detail geometry, cheapest first
+GEOMETRY_FILTERS = [  # (reason, function of (geometry, context) returning True to reject the route)
+    ("Geometry missing", lambda geometry, c: geometry is None),
+    ("Invalid line data", lambda geometry, c: geometry[0] not in ("LineString", "MultiLineString")),
+    ("Segment too long", lambda geometry, c: segment_too_long_array(geometry[1], c["m_per_deg_lat"], c["m_per_deg_lon"])),
+]
+
+def filter_route_table(table, rows, operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats):
+    # applies TABLE_FILTERS to the given rows, returns the rows that pass
+    min_lon, min_lat, max_lon, max_lat = table["extent"][rows].T
+    with np.errstate(invalid="ignore"):
+        diagonal = np.sqrt(((max_lon - min_lon) * m_per_deg_lon) ** 2 + ((max_lat - min_lat) * m_per_deg_lat) ** 2)
+
+    columns = {
+        "operators": table["operators"].tolist(),
+        "modes": table["modes"].tolist(),
+        "operator": table["operator"][rows],
+        "mode": table["mode"][rows],
+        "is_public": table["is_public"][rows],
+        "frequency": table["frequency"][rows],
+        "extent": table["extent"][rows],
+        "diagonal": diagonal,
+        "operator_colors": operator_colors,
+    }
+
+    remaining = np.ones(len(rows), dtype=bool)
+    for reason, function in TABLE_FILTERS:
+        start = time.perf_counter()
+        with np.errstate(invalid="ignore"):
+            rejected = function(columns)
+        if rejected is None:
+            continue
+        rejected = rejected & remaining
+        count = int(rejected.sum())
+        remaining &= ~rejected
+        filter_stats.add(reason, count, time.perf_counter() - start)
+
+    return rows[remaining]
+
+def filter_geometry(geometry, context, filter_stats):  # applies GEOMETRY_FILTERS to one route, returns the reason it was rejected or None
+    for reason, function in GEOMETRY_FILTERS:
+        start = time.perf_counter()
+        rejected = function(geometry, context)
+        filter_stats.add(reason, int(rejected), time.perf_counter() - start)
+        if rejected:
+            return reason
+    return None
+
+def select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats):  # returns (route table, rows left after the route table filters, total routes)
+    table = load_route_table()
+    total_routes = len(table["service_id"])
+    rows = np.arange(total_routes)
+    rows = filter_route_table(table, rows, operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    return table, rows, total_routes
+
+def iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, status="Drawing", level=0):
+    # yields every route in rows that passes the geometry filters, in drawing order, with lines at the given level of detail
+    counter = total_routes - len(rows)  # routes ruled out by the route table filters count as already processed
+    context = {"m_per_deg_lat": m_per_deg_lat, "m_per_deg_lon": m_per_deg_lon}
+    progress = ProgressReporter(status, total_routes)
+
+    route_data = zip(
+        table["service_id"][rows].tolist(),
+        table["frequency"][rows].tolist(),
+        table["operators"][table["operator"][rows]].tolist(),
+        table["route_number"][rows].tolist(),
+    )
+
+    for service_id, frequency, operator, route_number in route_data:
+        counter += 1
+        progress.update(counter, f"Last filter: {Fore.YELLOW}{filter_stats.last}")
+
+        try:
+            load_start = time.perf_counter()
+            geometry = load_route_geometry(service_id, geometry_store)
+            run_report.time("geometry load", time.perf_counter() - load_start)
+            if filter_geometry(geometry, context, filter_stats):
+                continue
+
+            coords = geometry[1]  # always a list of lines, LineStrings are wrapped when loaded
+            if level and geometry_store is not None:  # only the pack has levels of detail, without it the full detail lines are drawn
+                load_start = time.perf_counter()
+                coords = load_route_geometry(service_id, geometry_store, level)[1]  # filters always use the full detail geometry
+                run_report.time("geometry load", time.perf_counter() - load_start)
+
+            width, brightness = get_style_for_frequency(frequency)
+            base_color = get_operator_color(operator, operator_colors)
+            color = scale_color(base_color, brightness)
+
+        except Exception as e:
+            print(
+                f"Error processing service {service_id}: {e}"
+            )  # should never happen
+            continue
+
+        yield {
+            "service_id": service_id,
+            "route_number": route_number,
+            "frequency": frequency,
+            "width": width,
+            "color": color,
+            "lines": coords,
+        }
+
+    progress.update(counter, f"Last filter: {Fore.YELLOW}{filter_stats.last}", force=True)
 
 def check_data():
     if not os.path.exists(MAPS_DIR):
@@ -670,66 +1785,792 @@ def check_data():
         input(
             f"{Fore.RED}Geometry data not found {Fore.WHITE}- {Fore.CYAN}Press {Fore.GREEN}[ENTER] {Fore.CYAN}to download from bustimes.org (Takes a while - Requires ~1.5GB)"
         )
-        download_geometry(0)
-    else:
-        numbers = []
-        for filename in os.listdir(GEOMETRY_DIR):
-            if filename.lower().endswith(".json"):
-                name_part = os.path.splitext(filename)[0]
-                if name_part.isdigit():
-                    numbers.append(int(name_part))
-
-        if numbers:
-            next_geometry = max(numbers) + 1
-            if UPDATE_GEOMETRY:
-                download_geometry(next_geometry)
+        download_geometry()
+    elif not load_geometry_ids():
+        input(
+            f"{Fore.RED}Geometry data not found {Fore.WHITE}- {Fore.CYAN}Press {Fore.GREEN}[ENTER] {Fore.CYAN}to download from bustimes.org (Takes a while - Requires ~1.5GB)"
+        )
+        download_geometry()
+    elif UPDATE_GEOMETRY:
+        download_geometry()
+
+    load_route_table()
+
+    if USE_GEOMETRY_PACK and geometry_pack_outdated():
+        pack_geometry()
+
+
+def refresh_display(dirty_rects):  # shows everything drawn since the last refresh and handles window events
+    if len(dirty_rects) > 32:
+        dirty_rects[:] = [dirty_rects[0].unionall(dirty_rects[1:])]  # one big update is faster than lots of overlapping small ones
+    pygame.display.update(dirty_rects)
+    dirty_rects.clear()
+
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            sys.exit()
+
+def print_filter_summary(filter_stats):
+    print(f"{Fore.CYAN}Filtered routes:")
+    print(Fore.CYAN + "=" * 48)
+
+    for reason, _ in TABLE_FILTERS + GEOMETRY_FILTERS:
+        if reason in filter_stats.counts:
+            print(
+                f"{Fore.CYAN}| {Fore.YELLOW}{reason:<25}{Fore.CYAN}| {Fore.YELLOW}{filter_stats.counts[reason]:<5} {Fore.CYAN}| {Fore.YELLOW}{filter_stats.seconds[reason] * 1000:>6.1f} ms {Fore.CYAN}|"
+            )
+
+    print(Fore.CYAN + "=" * 48)
+
+def dry_run():  # runs every filter over BOUNDING_BOX without drawing anything
+    min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree((min_lat + max_lat) / 2)
+
+    operator_colors = load_operator_colors(OPERATOR_COLORS_CSV)
+    geometry_store = open_geometry_store()
+    filter_stats = FilterStats()
+
+    table, rows, total_routes = select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    drawn_count = sum(1 for _ in iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, status="Checking"))
+
+    if geometry_store is not None:
+        geometry_store.close()
+
+    print(f"\n{Fore.GREEN}Finished dry run.\n")
+    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Routes that would be drawn: {Fore.YELLOW}{drawn_count}\n")
+    print_filter_summary(filter_stats)
+
+def mercator_pixels(line, zoom):  # (vertices, 2) array of lon, lat to web mercator pixel coordinates of the whole world at zoom
+    world_px = TILE_SIZE * 2 ** zoom
+    lat = np.radians(np.clip(line[:, 1], -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = (line[:, 0] + 180) / 360 * world_px
+    y = (1 - np.arcsinh(np.tan(lat)) / pi) / 2 * world_px
+    return np.column_stack((x, y))
+
+def mercator_lonlat(x, y, zoom):  # inverse of mercator_pixels for a single point
+    world_px = TILE_SIZE * 2 ** zoom
+    return x / world_px * 360 - 180, degrees(atan(sinh(pi * (1 - 2 * y / world_px))))
+
+def tile_range(bbox, zoom):  # (x range, y range) of the tiles covering bbox at zoom
+    min_lon, min_lat, max_lon, max_lat = bbox
+    (left, top), (right, bottom) = mercator_pixels(np.array([[min_lon, max_lat], [max_lon, min_lat]]), zoom)
+    last = 2 ** zoom - 1
+    return (
+        range(max(0, int(left // TILE_SIZE)), min(last, int(right // TILE_SIZE)) + 1),
+        range(max(0, int(top // TILE_SIZE)), min(last, int(bottom // TILE_SIZE)) + 1),
+    )
+
+def tile_bounds(zoom, x, y, padding_px):  # (min lon, min lat, max lon, max lat) of a tile, grown by padding_px on every side
+    west, north = mercator_lonlat(x * TILE_SIZE - padding_px, y * TILE_SIZE - padding_px, zoom)
+    east, south = mercator_lonlat((x + 1) * TILE_SIZE + padding_px, (y + 1) * TILE_SIZE + padding_px, zoom)
+    return west, south, east, north
+
+def tile_path(zoom, x, y, folder=None):  # folder defaults to TILES_DIR
+    return os.path.join(folder or TILES_DIR, str(zoom), str(x), f"{y}.png")
+
+render_worker = {}  # state of a tile or band rendering process, set up once by init_render_worker rather than sent with every tile or band
+
+def init_render_worker(routes):
+    render_worker["routes"] = routes
+    render_worker["geometry_store"] = open_geometry_store()
+    render_worker["padding_px"] = max(routes["width"], default=0) + 1  # so lines just outside a tile or band still draw their edge on it
+
+def tile_scale(zoom):  # meters per pixel of tiles at this zoom, in the middle of BOUNDING_BOX
+    center_lat = (BOUNDING_BOX[1] + BOUNDING_BOX[3]) / 2
+    return 2 * pi * 6378137 * cos(radians(center_lat)) / (TILE_SIZE * 2 ** zoom)
+
+def draw_tile(zoom, x, y, candidates=None):  # draws one tile, returns the image or None if nothing is on it
+    # candidates are the rows of the routes that might be on the tile in drawing order, None = check every route
+    level = lod_level(tile_scale(zoom))
+    routes = render_worker["routes"]
+    padding_px = render_worker["padding_px"]
+    west, south, east, north = tile_bounds(zoom, x, y, padding_px)
+    min_lon, min_lat, max_lon, max_lat = (routes["extent"] if candidates is None else routes["extent"][candidates]).T
+    intersecting = np.flatnonzero((max_lon >= west) & (min_lon <= east) & (max_lat >= south) & (min_lat <= north))  # stays in drawing order
+    if candidates is not None:
+        intersecting = candidates[intersecting]
+
+    image = None
+    origin = np.array([x * TILE_SIZE, y * TILE_SIZE])
+    for i in intersecting.tolist():
+        geometry = load_route_geometry(routes["service_id"][i], render_worker["geometry_store"], level)
+        if geometry is None:
+            continue
+        for line in geometry[1]:
+            if len(line) < 2:
+                continue
+            points = np.rint(mercator_pixels(line, zoom) - origin).astype(np.int64)
+            if points.max(axis=0).min() < -padding_px or points.min(axis=0).max() > TILE_SIZE + padding_px:
+                continue  # route passes near this tile but this line doesnt
+            if image is None:
+                image = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), BACKGROUND_COLOR)
+                draw = ImageDraw.Draw(image)
+            draw.line(points.ravel().tolist(), fill=routes["color"][i], width=routes["width"][i])
+    return image
+
+def render_tile(tile):  # renders one tile, returns True if anything was drawn on it
+    image = draw_tile(*tile)
+    path = tile_path(*tile)
+    if image is None:
+        if os.path.exists(path):
+            os.remove(path)  # left over from an earlier render, the routes that were on it have gone
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    image.save(path)
+    return True
+
+def render_band(band):  # draws the part of the map between two rows of pixels, returns the raw pixels
+    top, bottom, width_px, origin_lon, origin_lat, m_per_deg_lat, m_per_deg_lon, level = band
+    routes = render_worker["routes"]
+    padding_px = render_worker["padding_px"]
+    intersecting = np.flatnonzero((routes["bottom"] >= top - padding_px) & (routes["top"] <= bottom + padding_px))  # stays in drawing order
+
+    image = Image.new("RGBA", (width_px, bottom - top), BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(image)
+    offset = np.array([0, top])
+    for i in intersecting.tolist():
+        geometry = load_route_geometry(routes["service_id"][i], render_worker["geometry_store"], level)
+        for line in geometry[1]:
+            if len(line) < 2:
+                continue
+            points = geo_to_pixel_array(line, origin_lon, origin_lat, m_per_deg_lat, m_per_deg_lon, SCALE_M_PER_PX) - offset
+            draw.line(points.tolist(), fill=routes["color"][i], width=routes["width"][i])
+    return image.tobytes()
+
+def prepare_band_routes(routes, route_labels, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):  # works out which rows of pixels each route covers, and collects its label
+    band_routes = {"service_id": [], "top": [], "bottom": [], "width": [], "color": []}
+    points = []
+    for route in routes:
+        lines = [line for line in route["lines"] if len(line)]
+        if not lines:
+            continue
+        lats = np.concatenate(lines)[:, 1]
+        band_routes["service_id"].append(route["service_id"])
+        band_routes["top"].append(int(round((max_lat - lats.max()) * m_per_deg_lat / SCALE_M_PER_PX)))
+        band_routes["bottom"].append(int(round((max_lat - lats.min()) * m_per_deg_lat / SCALE_M_PER_PX)))
+        band_routes["width"].append(route["width"])
+        band_routes["color"].append(route["color"])
+
+        if DRAW_ROUTE_LABELS:
+            for line in lines:  # labels go on the last line drawn, same as when drawing on one core
+                if len(line) >= 2:
+                    points = geo_to_pixel_array(line, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, SCALE_M_PER_PX).tolist()
+            route_labels.append(
+                {
+                    "routeNumber": route["route_number"],
+                    "frequency": route["frequency"],
+                    "color": route["color"],
+                    "points": points,
+                }
+            )
+    band_routes["top"] = np.array(band_routes["top"], dtype=np.int64)
+    band_routes["bottom"] = np.array(band_routes["bottom"], dtype=np.int64)
+    return band_routes
+
+def split_bands(width_px, height_px, band_height, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):
+    level = lod_level(SCALE_M_PER_PX)
+    return [
+        (top, min(top + band_height, height_px), width_px, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, level)
+        for top in range(0, height_px, band_height)
+    ]
+
+def iter_bands(band_routes, bands):  # yields the pixels of each band in order, only a couple of finished bands per worker are kept waiting
+    if RENDER_WORKERS <= 1:
+        init_render_worker(band_routes)
+        try:
+            for band in bands:
+                yield render_band(band)
+        finally:
+            if render_worker["geometry_store"] is not None:
+                render_worker["geometry_store"].close()
+        return
+
+    with ProcessPoolExecutor(max_workers=min(RENDER_WORKERS, len(bands)), initializer=init_render_worker, initargs=(band_routes,)) as render_pool:
+        pending = deque()
+        for band in bands:
+            pending.append(render_pool.submit(render_band, band))
+            if len(pending) >= RENDER_WORKERS * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def render_bands(image, routes, route_labels, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):  # draws routes onto a headless image in RENDER_BANDS bands at once, returns the number of routes drawn
+    band_routes = prepare_band_routes(routes, route_labels, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+    width_px, height_px = image.size
+    bands = split_bands(width_px, height_px, -(-height_px // RENDER_BANDS), min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+
+    print(f"\n{Fore.GREEN}Drawing {Fore.YELLOW}{len(band_routes['service_id'])}{Fore.GREEN} routes in {Fore.YELLOW}{len(bands)}{Fore.GREEN} bands")
+    progress = ProgressReporter("Drawing band", len(bands))
+    for counter, (band, pixels) in enumerate(zip(bands, iter_bands(band_routes, bands)), 1):
+        top, bottom = band[:2]
+        image.paste(Image.frombytes("RGBA", (width_px, bottom - top), pixels), (0, top))
+        progress.update(counter, force=counter == len(bands))
+
+    return len(band_routes["service_id"])
+
+class PNGWriter:  # writes an RGBA PNG a few rows at a time, so the whole image never has to be in memory
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.file = open(path + ".tmp", "wb")
+        self.compressor = zlib.compressobj(PNG_COMPRESSION)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))  # 8 bit RGBA, no interlacing
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write_rows(self, pixels):  # raw RGBA bytes of one or more whole rows
+        rows = np.frombuffer(pixels, dtype=np.uint8).reshape(-1, self.width * 4)
+        filtered = np.zeros((len(rows), self.width * 4 + 1), dtype=np.uint8)  # first byte of each row is the filter type, 0 = none
+        filtered[:, 1:] = rows
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.write_chunk(b"IDAT", data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.write_chunk(b"IDAT", self.compressor.flush())
+            self.write_chunk(b"IEND", b"")
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.path + ".tmp", self.path)
         else:
-            input(
-                f"{Fore.RED}Geometry data not found {Fore.WHITE}- {Fore.CYAN}Press {Fore.GREEN}[ENTER] {Fore.CYAN}to download from bustimes.org (Takes a while - Requires ~1.5GB)"
+            os.remove(self.path + ".tmp")  # dont leave half a map behind
+
+def strips_reached(top, bottom, strip_count):  # strips of STRIP_HEIGHT rows that rows top up to bottom reach into
+    return range(max(top // STRIP_HEIGHT, 0), min((bottom - 1) // STRIP_HEIGHT + 1, strip_count))
+
+def stream_map(path, width_px, height_px, routes, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):  # draws a headless map one strip at a time straight into a PNG, returns the number of routes drawn
+    route_labels = []
+    band_routes = prepare_band_routes(routes, route_labels, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+    strips = split_bands(width_px, height_px, STRIP_HEIGHT, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+
+    # labels are placed over the whole map first, then each strip only draws the ones whose sprites reach into it
+    placed = place_route_labels(route_labels, measure_route_label) if DRAW_ROUTE_LABELS else []
+    route_margin = label_margin((DRAW_ROUTE_LABEL_BOX, ROUTE_LABEL_BOX_PADDING, ROUTE_LABEL_BOX_WIDTH, ROUTE_LABEL_BG_COLOR, ROUTE_LABEL_ALPHA))
+    strip_labels = [[] for _ in strips]
+    for label in placed:
+        text_height = measure_route_label(label[0])[1]
+        text_y = label[3] - text_height // 2  # the same as draw_route_labels
+        for strip in strips_reached(text_y - route_margin, text_y + text_height + route_margin, len(strips)):
+            strip_labels[strip].append(label)
+
+    strip_cities = [[] for _ in strips]
+    if DRAW_CITY_LABELS and os.path.isfile(CITIES_CSV):
+        city_margin = label_margin(city_label_style())
+        for city in city_labels(min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):
+            text_y, text_height = city[2:]
+            for strip in strips_reached(text_y - city_margin, text_y + text_height + city_margin, len(strips)):
+                strip_cities[strip].append(city)
+
+    print(f"\n{Fore.GREEN}Drawing {Fore.YELLOW}{len(band_routes['service_id'])}{Fore.GREEN} routes in {Fore.YELLOW}{len(strips)}{Fore.GREEN} strips")
+    progress = ProgressReporter("Drawing strip", len(strips))
+    with PNGWriter(path, width_px, height_px) as writer:
+        for counter, (strip, pixels) in enumerate(zip(strips, iter_bands(band_routes, strips)), 1):
+            top, bottom = strip[:2]
+            if strip_labels[counter - 1] or strip_cities[counter - 1]:
+                image = Image.frombytes("RGBA", (width_px, bottom - top), pixels)
+                draw_route_labels(image, None, m_per_deg_lat, m_per_deg_lon, placed=strip_labels[counter - 1], offset_y=top)
+                draw_city_labels(image, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, offset_y=top, labels=strip_cities[counter - 1])
+                pixels = image.tobytes()
+            writer.write_rows(pixels)
+            progress.update(counter, force=counter == len(strips))
+
+    return len(band_routes["service_id"])
+
+TILE_VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{ height: 100%; margin: 0; background: rgb{background}; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var map = L.map("map", {{minZoom: {min_zoom}, maxZoom: {max_zoom}, maxBounds: [[{min_lat}, {min_lon}], [{max_lat}, {max_lon}]]}});
+L.tileLayer("{{z}}/{{x}}/{{y}}.png", {{minZoom: {min_zoom}, maxZoom: {max_zoom}, errorTileUrl: "data:image/gif;base64,R0lGODlhAQABAAAAACw="}}).addTo(map);
+map.fitBounds([[{min_lat}, {min_lon}], [{max_lat}, {max_lon}]]);
+</script>
+</body>
+</html>
+"""
+
+def prepare_tile_routes():  # filters the routes of BOUNDING_BOX, returns (routes for init_render_worker, total routes, filter stats)
+    min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
+    center_lat = (min_lat + max_lat) / 2
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree(center_lat)
+
+    operator_colors = load_operator_colors(OPERATOR_COLORS_CSV)
+    geometry_store = open_geometry_store()
+    filter_stats = FilterStats()
+
+    table, rows, total_routes = select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    tile_routes = {"service_id": [], "extent": [], "width": [], "color": []}
+    for route in iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, status="Checking"):
+        lines = [line for line in route["lines"] if len(line)]
+        if not lines:
+            continue
+        vertices = np.concatenate(lines)
+        tile_routes["service_id"].append(route["service_id"])
+        tile_routes["extent"].append((*vertices.min(axis=0), *vertices.max(axis=0)))  # from the geometry, not routes.csv, so no drawn line is missed
+        tile_routes["width"].append(route["width"])
+        tile_routes["color"].append(route["color"])
+    tile_routes["extent"] = np.array(tile_routes["extent"], dtype=np.float64).reshape(-1, 4)
+
+    if geometry_store is not None:
+        geometry_store.close()
+    return tile_routes, total_routes, filter_stats
+
+def tile_viewer_html():  # leaflet page showing the tiles of BOUNDING_BOX, expects them next to it as zoom/x/y.png
+    min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
+    return TILE_VIEWER_HTML.format(
+        title=WINDOW_TITLE,
+        background=tuple(BACKGROUND_COLOR[:3]),
+        min_zoom=TILE_MIN_ZOOM,
+        max_zoom=TILE_MAX_ZOOM,
+        min_lon=min_lon,
+        min_lat=min_lat,
+        max_lon=max_lon,
+        max_lat=max_lat,
+    )
+
+def render_tiles():  # renders TILE_MIN_ZOOM to TILE_MAX_ZOOM tiles of BOUNDING_BOX, spread over RENDER_WORKERS processes
+    # filtering is done once here, so the workers only have to work out which of the remaining routes are on each tile
+    tile_routes, total_routes, filter_stats = prepare_tile_routes()
+
+    tiles = []
+    for zoom in range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1):
+        x_range, y_range = tile_range(BOUNDING_BOX, zoom)
+        tiles.extend((zoom, x, y) for x in x_range for y in y_range)
+
+    print(
+        f"\n{Fore.GREEN}Rendering {Fore.YELLOW}{len(tiles)}{Fore.GREEN} tiles of {Fore.YELLOW}{len(tile_routes['service_id'])}{Fore.GREEN} routes - Output will be saved to {Fore.YELLOW}{TILES_DIR}"
+    )
+    os.makedirs(TILES_DIR, exist_ok=True)
+
+    drawn_tiles = 0
+    progress = ProgressReporter("Rendering", len(tiles))
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=init_render_worker, initargs=(tile_routes,)) as render_pool:
+        for counter, (tile, drawn) in enumerate(zip(tiles, render_pool.map(render_tile, tiles, chunksize=16)), 1):
+            drawn_tiles += drawn
+            progress.update(counter, f"Zoom: {Fore.YELLOW}{tile[0]}", force=counter == len(tiles))
+
+    with open(os.path.join(TILES_DIR, "index.html"), "w", encoding="utf-8") as f:
+        f.write(tile_viewer_html())
+
+    print(f"\n{Fore.GREEN}Finished rendering tiles.\n")
+    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Drawn routes: {Fore.YELLOW}{len(tile_routes['service_id'])}")
+    print(f"{Fore.CYAN}Total tiles: {Fore.YELLOW}{len(tiles)}")
+    print(f"{Fore.CYAN}Drawn tiles: {Fore.YELLOW}{drawn_tiles} {Fore.CYAN}(empty tiles are not saved)\n")
+    print_filter_summary(filter_stats)
+
+
+def encode_tile(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=PNG_COMPRESSION)
+    return buffer.getvalue()
+
+def build_tile_index(extents, zoom, padding_px):  # {(x, y): rows of the routes whose extent, grown by padding_px, overlaps that tile at zoom}
+    cells = defaultdict(list)
+    last = 2 ** zoom - 1
+    corners = mercator_pixels(extents[:, [0, 3, 2, 1]].reshape(-1, 2), zoom).reshape(-1, 4)  # left, top, right, bottom of every extent
+    for row, (left, top, right, bottom) in enumerate(corners.tolist()):
+        for x in range(max(0, int((left - padding_px) // TILE_SIZE)), min(last, int((right + padding_px) // TILE_SIZE)) + 1):
+            for y in range(max(0, int((top - padding_px) // TILE_SIZE)), min(last, int((bottom + padding_px) // TILE_SIZE)) + 1):
+                cells[(x, y)].append(row)
+    return {cell: np.array(rows, dtype=np.int64) for cell, rows in cells.items()}
+
+class TileCache:  # encoded tiles kept in memory up to max_bytes, the least recently used are dropped first and saved in folder if there is one
+    def __init__(self, max_bytes, folder):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.on_disk = set()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.lock = threading.Lock()
+
+    def get(self, tile):  # returns the encoded tile, or None if it hasnt been drawn yet
+        with self.lock:
+            data = self.tiles.get(tile)
+            if data is not None:
+                self.tiles.move_to_end(tile)
+                self.memory_hits += 1
+                return data
+            if tile not in self.on_disk:
+                return None
+        try:
+            with open(tile_path(*tile, self.folder), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:  # deleted while the server was running
+            with self.lock:
+                self.on_disk.discard(tile)
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        self.put(tile, data)
+        return data
+
+    def put(self, tile, data):
+        dropped = []
+        with self.lock:
+            if tile in self.tiles:
+                return
+            self.tiles[tile] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.tiles) > 1:
+                old_tile, old_data = self.tiles.popitem(last=False)
+                self.size -= len(old_data)
+                if self.folder and old_tile not in self.on_disk:
+                    dropped.append((old_tile, old_data))
+
+        for old_tile, old_data in dropped:  # written without holding the lock, so cached tiles are never kept waiting on the disk
+            path = tile_path(*old_tile, self.folder)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(old_data)
+            os.replace(temp_path, path)
+            with self.lock:
+                self.on_disk.add(old_tile)
+
+class TileServer(ThreadingHTTPServer):  # serves the tiles of BOUNDING_BOX, drawing each one the first time it is asked for
+    daemon_threads = True
+
+    def __init__(self, address, tile_index):
+        super().__init__(address, TileRequestHandler)
+        self.tile_index = tile_index
+        self.no_routes = np.empty(0, dtype=np.int64)
+        self.cache = TileCache(TILE_CACHE_MB * 1024 * 1024, TILE_CACHE_DIR)
+        self.viewer_html = tile_viewer_html().encode("utf-8")
+        self.empty_tile = encode_tile(Image.new("RGBA", (TILE_SIZE, TILE_SIZE), BACKGROUND_COLOR))
+        self.served = 0
+        self.drawn = 0
+        self.draw_seconds = 0.0
+        self.last_print = 0
+        self.lock = threading.Lock()
+
+    def get_tile(self, zoom, x, y):  # the encoded tile, drawn now if it isnt cached
+        tile = (zoom, x, y)
+        data = self.cache.get(tile)
+        if data is None:
+            start = time.perf_counter()
+            candidates = None
+            if zoom >= TILE_INDEX_ZOOM:
+                shift = zoom - TILE_INDEX_ZOOM
+                candidates = self.tile_index.get((x >> shift, y >> shift), self.no_routes)
+            image = draw_tile(zoom, x, y, candidates)
+            data = self.empty_tile if image is None else encode_tile(image)
+            self.cache.put(tile, data)
+            with self.lock:
+                self.drawn += 1
+                self.draw_seconds += time.perf_counter() - start
+        with self.lock:
+            self.served += 1
+        self.print_status()
+        return data
+
+    def print_status(self, force=False):
+        with self.lock:
+            now = time.perf_counter()
+            if not force and now - self.last_print < PROGRESS_INTERVAL:
+                return
+            self.last_print = now
+            average_ms = self.draw_seconds / self.drawn * 1000 if self.drawn else 0
+            print(
+                f"{Fore.CYAN}Served {Fore.YELLOW}{self.served}{Fore.CYAN} tiles | Drawn: {Fore.YELLOW}{self.drawn}{Fore.CYAN} ({Fore.YELLOW}{average_ms:.1f} ms{Fore.CYAN} each) "
+                f"| Cached: {Fore.YELLOW}{self.cache.memory_hits}{Fore.CYAN} memory, {Fore.YELLOW}{self.cache.disk_hits}{Fore.CYAN} disk | {Fore.YELLOW}{self.cache.size / 1024 / 1024:.1f}{Fore.CYAN}/{Fore.GREEN}{TILE_CACHE_MB} MB          ",
+                end="\r",
             )
-            download_geometry(0)
 
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/", "/index.html"):
+            self.send_data(self.server.viewer_html, "text/html; charset=utf-8")
+            return
+
+        match = TILE_URL.fullmatch(path)
+        if match:
+            zoom, x, y = map(int, match.groups())
+            if TILE_MIN_ZOOM <= zoom <= TILE_MAX_ZOOM and x < 2 ** zoom and y < 2 ** zoom:
+                self.send_data(self.server.get_tile(zoom, x, y), "image/png")
+                return
+        self.send_error(404)
+
+    def send_data(self, data, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # a line for every tile would bury the status line
+
+def serve_tiles():  # serves tiles of BOUNDING_BOX from TILE_MIN_ZOOM to TILE_MAX_ZOOM, drawn as a browser asks for them, until stopped with ctrl+c
+    tile_routes, total_routes, filter_stats = prepare_tile_routes()
+    init_render_worker(tile_routes)  # the server draws tiles itself on its request threads
+    tile_index = build_tile_index(tile_routes["extent"], TILE_INDEX_ZOOM, render_worker["padding_px"])
+
+    if TILE_CACHE_DIR and os.path.isdir(TILE_CACHE_DIR):  # left from an earlier run that might have had different settings or data
+        for name in os.listdir(TILE_CACHE_DIR):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(TILE_CACHE_DIR, name))
+
+    server = TileServer((TILE_SERVER_HOST, TILE_SERVER_PORT), tile_index)
+    print(f"\n{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Routes on the map: {Fore.YELLOW}{len(tile_routes['service_id'])}\n")
+    print_filter_summary(filter_stats)
+    print(f"\n{Fore.GREEN}Serving tiles at {Fore.YELLOW}http://{TILE_SERVER_HOST}:{TILE_SERVER_PORT}/ {Fore.WHITE}- {Fore.CYAN}Press {Fore.GREEN}[CTRL+C] {Fore.CYAN}to stop")
 
-def main():
-    ascii_art = f'''{Fore.RED}
-     .---------------------------.            .---------------------------.
-   .' .--..---..---..---..---..--⹁\\          /,--..---..---..---..---..--. `.
-   |_/___||___||___||___||___||___\\\\        //___||___||___||___||___||___\\_|
-   |_] ######################## __|]        [|__ ######################## [_|
-   |============================/              \\============================|
-   ||"""| |"""||"""||"""||"""|  |==.        .==|  |"""||"""||"""||"""| |"""||
-   ||=  |="---""---""---""---"======\\      /======"---""---""---""---"=|  =||
-   ||== |  ____          *[]    ____|      |____    []*          ____  | ==||
-   ||===| //  \\\\               //  \\\\      //  \\\\               //  \\\\ |===||
-   `+---+-"\__/"---------------"\__/"      "\__/"---------------"\__/"-+---+'
-{Fore.YELLOW}================================================================================{Fore.RED}
- _    ____________  __  ____  ______________   ____________  {Fore.CYAN}  ____  __  _______{Fore.RED}
-| |  / / ____/ __ \/ / / /  |/  /  _/ ____/ | / /  _/ ___/ / {Fore.CYAN} / __ )/ / / / ___/{Fore.RED}
-| | / / __/ / /_/ / / / / /|_/ // // / __/  |/ // / \__ \|/ {Fore.CYAN} / __  / / / /\__ \ {Fore.RED}
-| |/ / /___/ _, _/ /_/ / /  / // // /_/ / /|  // / ___/ /  {Fore.CYAN} / /_/ / /_/ /___/ / {Fore.RED}
-|___/_____/_/_|_|\____/_/  /_/___/\____/_/ |_/___//____/ {Fore.CYAN}__/_____/\____//____/
-   /  |/  /   |  / __ \   / ____/ ____/ | / / ____/ __ \/   |/_  __/ __ \/ __ \ 
-  / /|_/ / /| | / /_/ /  / / __/ __/ /  |/ / __/ / /_/ / /| | / / / / / / /_/ / 
- / /  / / ___ |/ ____/  / /_/ / /___/ /|  / /___/ _, _/ ___ |/ / / /_/ / _, _/  
-/_/  /_/_/  |_/_/       \____/_____/_/ |_/_____/_/ |_/_/  |_/_/  \____/_/ |_|   
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if render_worker["geometry_store"] is not None:
+            render_worker["geometry_store"].close()
+
+    server.print_status(force=True)
+    print(f"\n{Fore.GREEN}Stopped tile server.")
+
+
+def line_pixels(points):  # every pixel a line of integer pixel points passes through, found for all segments at once
+    starts = points[:-1]
+    deltas = np.diff(points, axis=0)
+    steps = np.maximum(np.abs(deltas).max(axis=1), 1)  # one sample per pixel along the longer axis of each segment
+    segment = np.repeat(np.arange(len(steps)), steps)
+    t = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segment]
+    pixels = np.rint(starts[segment] + deltas[segment] * t[:, None]).astype(np.int64)
+    return np.concatenate((pixels, points[-1:]))
+
+def heatmap_colors(grid):  # maps buses per day to HEATMAP_COLORS, returns an RGB array
+    stops = sorted(HEATMAP_COLORS, key=lambda stop: stop[0])
+    positions = np.log1p([stop[0] for stop in stops])
+    colors = np.array([stop[1] for stop in stops], dtype=np.float32)
+    values = np.log1p(grid)
+
+    rgb = np.empty(grid.shape + (3,), dtype=np.uint8)
+    for channel in range(3):
+        rgb[..., channel] = np.rint(np.interp(values, positions, colors[:, channel]))
+    rgb[grid <= 0] = BACKGROUND_COLOR[:3]
+    return rgb
+
+def render_heatmap(output_file):  # adds every route's buses per day to each pixel it passes through, instead of drawing routes over each other
+    min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
+    center_lat = (min_lat + max_lat) / 2
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree(center_lat)
 
-'''
-    print(ascii_art)
+    operator_colors = load_operator_colors(OPERATOR_COLORS_CSV)
+    geometry_store = open_geometry_store()
+    filter_stats = FilterStats()
 
-    check_data()  # make sure all data exists, if not, download it
+    width_px = int((max_lon - min_lon) * m_per_deg_lon / SCALE_M_PER_PX)
+    height_px = int((max_lat - min_lat) * m_per_deg_lat / SCALE_M_PER_PX)
+    grid = np.zeros((height_px, width_px), dtype=np.float32)
+    flat_grid = grid.reshape(-1)
 
+    print(
+        f"{Fore.GREEN}Drawing heatmap - Output will be saved to {Fore.YELLOW}{os.path.join(MAPS_DIR, output_file)}"
+    )
+
+    run_report.filter_stats = filter_stats
+    drawn_count = 0
+    with run_report.phase("select routes"):
+        table, rows, total_routes = select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    with run_report.phase("draw routes"):
+        for route in iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, level=lod_level(SCALE_M_PER_PX)):
+            pixels = [
+                line_pixels(geo_to_pixel_array(line, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon, SCALE_M_PER_PX))
+                for line in route["lines"] if len(line)
+            ]
+            if not pixels:
+                continue
+            pixels = np.concatenate(pixels)
+            x, y = pixels[:, 0], pixels[:, 1]
+            inside = (x >= 0) & (x < width_px) & (y >= 0) & (y < height_px)
+            flat_grid[np.unique(y[inside] * width_px + x[inside])] += route["frequency"]  # each route counts once per pixel, even where it doubles back
+            drawn_count += 1
+
+    if geometry_store is not None:
+        geometry_store.close()
+
+    with run_report.phase("save"):
+        image = Image.fromarray(heatmap_colors(grid), "RGB").convert("RGBA")
+        if HEADLESS_RENDERING:  # city labels need the pillow fonts
+            draw_city_labels(image, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+        image.save(os.path.join(MAPS_DIR, output_file))
+    run_report.count("routes", total_routes)
+    run_report.count("routes drawn", drawn_count)
+
+    print(f"\n{Fore.GREEN}Finished drawing heatmap.\n")
+    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Drawn routes: {Fore.YELLOW}{drawn_count}")
+    print(f"{Fore.CYAN}Busiest pixel: {Fore.YELLOW}{grid.max():.0f}{Fore.CYAN} buses per day\n")
+    print_filter_summary(filter_stats)
+
+def quantize_line(points, decimals):  # rounds points to decimals places and leaves out any that land on the point before, None = no rounding
+    if decimals is None:
+        return points
+    points = np.round(points, decimals)
+    moved = np.ones(len(points), dtype=bool)
+    moved[1:] = (points[1:] != points[:-1]).any(axis=1)
+    return points[moved]
+
+def hex_color(color):
+    return "#{:02x}{:02x}{:02x}".format(*color[:3])
+
+class VectorWriter:  # writes a vector file one route at a time, so the whole map never has to be in memory
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + ".tmp", "w", encoding="utf-8")
+
+    def __enter__(self):
+        self.write_header()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.write_footer()
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            os.remove(self.path + ".tmp")  # dont leave half a map behind
+
+class SVGWriter(VectorWriter):  # one path per route, in drawing order so routes overlap the same way they do in images
+    def __init__(self, path, width_px, height_px, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon):
+        super().__init__(path)
+        self.width_px = width_px
+        self.height_px = height_px
+        self.origin = np.array([min_lon, max_lat])
+        self.scale = np.array([m_per_deg_lon, -m_per_deg_lat]) / SCALE_M_PER_PX
+
+    def write_header(self):
+        self.file.write(
+            f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width_px}" height="{self.height_px}" viewBox="0 0 {self.width_px} {self.height_px}">\n'
+            f'<rect width="100%" height="100%" fill="{hex_color(BACKGROUND_COLOR)}"/>\n'
+            f'<g fill="none" stroke-linejoin="round">\n'
+        )
+
+    def write_route(self, route):  # returns True if any of the route was written
+        path = []
+        for line in route["lines"]:
+            if len(line) < 2:
+                continue
+            points = quantize_line((line - self.origin) * self.scale, SVG_DECIMALS)  # same projection as geo_to_pixel_array, without rounding to whole pixels
+            if len(points) < 2:
+                continue
+            if SVG_DECIMALS == 0:
+                points = points.astype(np.int64)
+            path.append("M" + " ".join(map(str, points.ravel().tolist())))  # points after the first are joined with straight lines
+        if not path:
+            return False
+        self.file.write(f'<path stroke="{hex_color(route["color"])}" stroke-width="{route["width"]}" d="{"".join(path)}"/>\n')
+        return True
+
+    def write_footer(self):
+        self.file.write("</g>\n</svg>\n")
+
+class GeoJSONWriter(VectorWriter):  # one MultiLineString feature per route, styled with the stroke properties most map tools understand
+    def write_header(self):
+        self.file.write('{"type":"FeatureCollection","features":[\n')
+        self.first = True
+
+    def write_route(self, route):  # returns True if any of the route was written
+        lines = [quantize_line(line, GEOJSON_DECIMALS).tolist() for line in route["lines"] if len(line) >= 2]
+        lines = [line for line in lines if len(line) >= 2]
+        if not lines:
+            return False
+        feature = {
+            "type": "Feature",
+            "properties": {
+                "service_id": route["service_id"],
+                "route_number": route["route_number"],
+                "frequency": route["frequency"],
+                "stroke": hex_color(route["color"]),
+                "stroke-width": route["width"],
+            },
+            "geometry": {"type": "MultiLineString", "coordinates": lines},
+        }
+        self.file.write(("" if self.first else ",\n") + json.dumps(feature, separators=(",", ":")))
+        self.first = False
+        return True
+
+    def write_footer(self):
+        self.file.write("\n]}\n")
+
+def export_vector(output_file):  # saves the routes of BOUNDING_BOX as an svg or geojson file, written one route at a time as they are read
     min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
     center_lat = (min_lat + max_lat) / 2
     m_per_deg_lat, m_per_deg_lon = meters_per_degree(center_lat)
 
     operator_colors = load_operator_colors(OPERATOR_COLORS_CSV)
+    geometry_store = open_geometry_store()
+    filter_stats = FilterStats()
+
+    path = os.path.join(MAPS_DIR, output_file)
+    if RENDER_MODE == "svg":
+        width_px = int((max_lon - min_lon) * m_per_deg_lon / SCALE_M_PER_PX)
+        height_px = int((max_lat - min_lat) * m_per_deg_lat / SCALE_M_PER_PX)
+        writer = SVGWriter(path, width_px, height_px, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+    else:
+        writer = GeoJSONWriter(path)
+
+    print(
+        f"{Fore.GREEN}Exporting {RENDER_MODE} - Output will be saved to {Fore.YELLOW}{path}"
+    )
+
+    run_report.filter_stats = filter_stats
+    drawn_count = 0
+    with run_report.phase("select routes"):
+        table, rows, total_routes = select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    with run_report.phase("export routes"), writer:
+        for route in iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, status="Exporting", level=lod_level(SCALE_M_PER_PX)):
+            drawn_count += writer.write_route(route)
+
+    if geometry_store is not None:
+        geometry_store.close()
+    run_report.count("routes", total_routes)
+    run_report.count("routes drawn", drawn_count)
+
+    print(f"\n{Fore.GREEN}Finished exporting {RENDER_MODE}.\n")
+    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Exported routes: {Fore.YELLOW}{drawn_count}\n")
+    print_filter_summary(filter_stats)
+
+def render_map(output_file):  # draws BOUNDING_BOX as one map and saves it in MAPS_DIR
+    min_lon, min_lat, max_lon, max_lat = BOUNDING_BOX
+    center_lat = (min_lat + max_lat) / 2
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree(center_lat)
+
+    operator_colors = load_operator_colors(OPERATOR_COLORS_CSV)
+    geometry_store = open_geometry_store()
 
     width_m = (max_lon - min_lon) * m_per_deg_lon
     height_m = (max_lat - min_lat) * m_per_deg_lat
     width_px = int(width_m / SCALE_M_PER_PX)
     height_px = int(height_m / SCALE_M_PER_PX)
 
-    if HEADLESS_RENDERING:
+    if HEADLESS_RENDERING and STREAM_OUTPUT:
+        pass  # nothing is drawn until the strips are
+    elif HEADLESS_RENDERING:
         image = Image.new("RGBA", (width_px, height_px), BACKGROUND_COLOR)
         draw = ImageDraw.Draw(image)
     else:
@@ -740,278 +2581,361 @@ def main():
         screen.fill(BACKGROUND_COLOR)
 
     route_labels = []
-    filter_counters = defaultdict(int)
+    filter_stats = FilterStats()
+    run_report.filter_stats = filter_stats
     drawn_count = 0
-    last_filter = "None filtered yet"
-    counter = 0
-
-    # work out what the file name should be
-    numbers = []
-    for filename in os.listdir(MAPS_DIR):
-        if filename.lower().endswith(".png"):
-            name_part = os.path.splitext(filename)[0]
-            if name_part.isdigit():
-                numbers.append(int(name_part))
-
-    if numbers:
-        output_file = str(max(numbers) + 1) + ".png"
-    else:
-        output_file = "1.png"
 
     print(
         f"{Fore.GREEN}Drawing bus map - Output will be saved to {Fore.YELLOW}{os.path.join(MAPS_DIR, output_file)}"
     )
 
-    with open(ROUTES_CSV, newline="", encoding="utf-8") as csvfile:
-        total_routes = (
-            sum(1 for _ in open(ROUTES_CSV, encoding="utf-8")) - 1
-        )  # count the total routes
-        csvfile.seek(0)  # rewind
-        reader = csv.DictReader(csvfile)
+    with run_report.phase("select routes"):
+        table, rows, total_routes = select_routes(operator_colors, m_per_deg_lat, m_per_deg_lon, filter_stats)
+    with run_report.phase("draw routes"):  # geometry is read as routes are drawn, so loading and drawing share a phase
+        routes = iter_routes(table, rows, total_routes, operator_colors, geometry_store, m_per_deg_lat, m_per_deg_lon, filter_stats, level=lod_level(SCALE_M_PER_PX))
+
+        if HEADLESS_RENDERING and STREAM_OUTPUT:
+            drawn_count = stream_map(os.path.join(MAPS_DIR, output_file), width_px, height_px, routes, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+            routes = []
+        elif HEADLESS_RENDERING and RENDER_BANDS > 1:
+            drawn_count = render_bands(image, routes, route_labels, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+            routes = []
+
+        points = []
+        vertices_drawn = 0
+        dirty_rects = []  # parts of the window drawn on since it was last updated
+        last_refresh = time.perf_counter()
+        for route in routes:
+            drawn_count += 1
+            for line in route["lines"]:
+                if len(line) < 2:
+                    continue
+                projection_start = time.perf_counter()
+                points = geo_to_pixel_array(
+                    line,
+                    min_lon,
+                    max_lat,
+                    m_per_deg_lat,
+                    m_per_deg_lon,
+                    SCALE_M_PER_PX,
+                ).tolist()
+                run_report.time("projection", time.perf_counter() - projection_start)
+                vertices_drawn += len(points)
 
-        for row in reader:
-            counter += 1
-
-            is_public = row.get("isPublicService", "").lower() == "true"
-            operator = row.get("operator", "").strip()
-            mode = row.get("mode", "").strip()
-
-            # public/private filtering
-            if SHOW_ONLY_PRIVATE_ROUTES and is_public:
-                filter_counters["Route is public"] += 1
-                last_filter = "Route is public"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Route is public          ",
-                    end="\r",
-                )
-                continue
-            elif IGNORE_PRIVATE_ROUTES and not is_public:
-                filter_counters["Route is private"] += 1
-                last_filter = "Route is private"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Route is private          ",
-                    end="\r",
+                if HEADLESS_RENDERING:
+                    draw.line(points, fill=route["color"], width=route["width"])
+                else:
+                    dirty_rects.append(pygame.draw.lines(screen, route["color"], False, points, route["width"]))
+
+            if DRAW_ROUTE_LABELS:
+                route_labels.append(
+                    {
+                        "routeNumber": route["route_number"],
+                        "frequency": route["frequency"],
+                        "color": route["color"],
+                        "points": points,
+                    }
                 )
-                continue
 
-            # mode/operator filtering
-            if INCLUDE_OPERATORS and operator not in INCLUDE_OPERATORS:
-                filter_counters["Operator not included"] += 1
-                last_filter = "Operator not included"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Operator not included          ",
-                    end="\r",
-                )
-                continue
-            if operator in EXCLUDE_OPERATORS:
-                filter_counters["Operator excluded"] += 1
-                last_filter = "Operator excluded"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Operator excluded          ",
-                    end="\r",
-                )
-                continue
+            if not HEADLESS_RENDERING and time.perf_counter() - last_refresh >= DISPLAY_REFRESH_MS / 1000:
+                refresh_display(dirty_rects)
+                last_refresh = time.perf_counter()
 
-            if INCLUDE_MODES and mode not in INCLUDE_MODES:
-                filter_counters["Mode not included"] += 1
-                last_filter = "Mode not included"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Mode not included          ",
-                    end="\r",
-                )
-                continue
-            if mode in EXCLUDE_MODES:
-                filter_counters["Mode excluded"] += 1
-                last_filter = "Mode excluded"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Mode excluded          ",
-                    end="\r",
-                )
-                continue
+        if not HEADLESS_RENDERING:
+            refresh_display(dirty_rects)
+        run_report.count("vertices drawn", vertices_drawn)
 
-            try:
-                extent = json.loads(row["extent"])
-                route_bbox = tuple(extent)
-                if not bbox_intersects(route_bbox, BOUNDING_BOX):
-                    filter_counters["Out of bounding box"] += 1
-                    last_filter = "Out of bounding box"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Out of bounding box          ",
-                        end="\r",
-                    )
-                    continue
+    if geometry_store is not None:
+        geometry_store.close()
 
-                diagonal = bbox_diagonal_distance(
-                    route_bbox, m_per_deg_lat, m_per_deg_lon
-                )
-                if diagonal > MAX_ROUTE_LENGTH:
-                    filter_counters["Route too long"] += 1
-                    last_filter = "Route too long"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Route too long          ",
-                        end="\r",
-                    )
-                    continue
+    if HEADLESS_RENDERING and STREAM_OUTPUT:
+        pass  # labels were drawn on each strip and the PNG is already saved
+    else:
+        canvas = image if HEADLESS_RENDERING else screen
+        with run_report.phase("route labels"):
+            draw_route_labels(canvas, route_labels, m_per_deg_lat, m_per_deg_lon)
+        with run_report.phase("city labels"):
+            draw_city_labels(canvas, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
 
-                if diagonal < MIN_ROUTE_LENGTH:
-                    filter_counters["Route too short"] += 1
-                    last_filter = "Route too short"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Route too short          ",
-                        end="\r",
-                    )
-                    continue
+        with run_report.phase("save"):
+            if HEADLESS_RENDERING:
+                image.save(os.path.join(MAPS_DIR, output_file))
+            else:
+                pygame.display.flip()
+                pygame.image.save(screen, os.path.join(MAPS_DIR, output_file))
+        if not HEADLESS_RENDERING:
+            pygame.quit()
 
-            except Exception:
-                filter_counters["Bad bounding box"] += 1
-                last_filter = "Bad bounding box"
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Bad bounding box          ",
-                    end="\r",
-                )
+    run_report.count("routes", total_routes)
+    run_report.count("routes drawn", drawn_count)
+
+    print(f"\n{Fore.GREEN}Finished drawing bus map.\n")
+    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{total_routes}")
+    print(f"{Fore.CYAN}Drawn routes: {Fore.YELLOW}{drawn_count}\n")
+    print_label_cache_summary()
+    print_filter_summary(filter_stats)
+
+
+def check_settings(settings):  # returns what is wrong with the settings, settings is globals() or globals() with a batch job's changes
+    problems = []
+    if not all(isinstance(position, (int, float)) and 0 < position <= 1 for position in settings["ROUTE_LABEL_POSITIONS"]):
+        problems.append("ROUTE_LABEL_POSITIONS must all be more than 0 and no more than 1")
+    return problems
+
+def check_batch_jobs():  # returns what is wrong with BATCH_JOBS, nothing is drawn unless this is empty
+    problems = []
+    if not HEADLESS_RENDERING:
+        problems.append("batch jobs are drawn in background processes, so HEADLESS_RENDERING must be True")
+
+    names = set()
+    for number, job in enumerate(BATCH_JOBS, 1):
+        name = job.get("name")
+        if not isinstance(name, str) or not name or os.path.basename(name) != name:
+            problems.append(f"job {number} needs a name that can be used as a file name")
+            continue
+        if job.get("RENDER_MODE", RENDER_MODE) == "server":
+            problems.append(f"{name}: the tile server runs until it is stopped, so it cant be a batch job")
+        if name in names:
+            problems.append(f"more than one job is called {name}")
+        names.add(name)
+
+        for key in job:
+            if key == "name":
                 continue
+            if key in BATCH_FIXED_SETTINGS:
+                problems.append(f"{name}: {key} cant be changed for one job")
+            elif not key.isupper() or key not in globals():
+                problems.append(f"{name}: there is no setting called {key}")
+        problems.extend(f"{name}: {problem}" for problem in check_settings(dict(globals(), **job)))
+    return problems
+
+def batch_job_output(job):  # where a batch job is saved
+    if job.get("RENDER_MODE", RENDER_MODE) == "tiles":
+        return job.get("TILES_DIR", os.path.join(TILES_DIR, job["name"]))
+    return os.path.join(MAPS_DIR, job["name"] + OUTPUT_EXTENSIONS.get(job.get("RENDER_MODE", RENDER_MODE), ".png"))
+
+def run_batch_job(job):  # draws one batch job in a worker process, returns (what render_output returned, error message if it failed)
+    global run_report
+    run_report = RunReport()  # each job gets its own report, not one that carries on from the last job in this process
+    settings = {key: value for key, value in job.items() if key != "name"}
+    settings.setdefault("RENDER_WORKERS", 1)  # the other jobs are using the rest of the cores
+    settings.setdefault("TILES_DIR", os.path.join(TILES_DIR, job["name"]))
+    previous = {key: globals()[key] for key in settings}
+    globals().update(settings)
 
-            try:
-                service_id = row["serviceID"]
-                frequency = int(row["frequency"])
-
-                width, brightness = get_style_for_frequency(frequency)
-                base_color = get_operator_color(operator, operator_colors)
-                color = scale_color(base_color, brightness)
-
-                if SHOW_ONLY_UNCOLORED and base_color != (255, 255, 255):
-                    filter_counters["Operator color set"] += 1
-                    last_filter = "Operator color set"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Operator color set          ",
-                        end="\r",
-                    )
-                    continue
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # progress lines from several jobs at once would be unreadable
+            if RENDER_MODE == "tiles":
+                render_tiles()
+                return None, None
+            return render_output(job["name"] + OUTPUT_EXTENSIONS.get(RENDER_MODE, ".png")), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    finally:
+        globals().update(previous)  # the process is reused for later jobs
+
+def render_batch():  # draws every job in BATCH_JOBS, spread over BATCH_WORKERS processes
+    problems = check_batch_jobs()
+    if problems:
+        for problem in problems:
+            print(f"{Fore.RED}Batch jobs not drawn {Fore.WHITE}- {Fore.CYAN}{problem}")
+        return
 
-                if width <= 0:
-                    filter_counters["Low frequency"] += 1
-                    last_filter = "Low frequency"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Low frequency          ",
-                        end="\r",
-                    )
-                    continue
+    # loaded once here, worker processes are forked from this one so they start with it already in memory
+    load_route_table()
+    load_operator_colors(OPERATOR_COLORS_CSV)
+    load_fonts(HEADLESS_RENDERING)
+
+    print(f"{Fore.GREEN}Drawing {Fore.YELLOW}{len(BATCH_JOBS)}{Fore.GREEN} batch jobs on {Fore.YELLOW}{min(BATCH_WORKERS, len(BATCH_JOBS))}{Fore.GREEN} processes")
+
+    errors = {}
+    renders = {}
+    start = time.perf_counter()
+    progress = ProgressReporter("Drawing", len(BATCH_JOBS))
+    with ProcessPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(BATCH_JOBS)))) as batch_pool:
+        jobs = {batch_pool.submit(run_batch_job, job): job["name"] for job in BATCH_JOBS}
+        for counter, future in enumerate(as_completed(jobs), 1):
+            render, error = future.result()
+            if error:
+                errors[jobs[future]] = error
+            elif render:
+                renders[jobs[future]] = render
+            progress.update(counter, f"Last finished: {Fore.YELLOW}{jobs[future]}", force=counter == len(jobs))
+    record_renders([render[:2] for render in renders.values()])  # written here rather than by each job, so jobs finishing together dont lose each others entries
+
+    print(f"\n{Fore.GREEN}Finished batch in {Fore.YELLOW}{time.perf_counter() - start:.1f}s\n")
+    for job in BATCH_JOBS:
+        if job["name"] in errors:
+            print(f"{Fore.RED}{job['name']} failed {Fore.WHITE}- {Fore.YELLOW}{errors[job['name']]}")
+        else:
+            reused = f" {Fore.CYAN}(already drawn)" if job["name"] in renders and not renders[job["name"]][2] else ""
+            print(f"{Fore.CYAN}{job['name']} {Fore.WHITE}- {Fore.YELLOW}{batch_job_output(job)}{reused}")
 
-                path = os.path.join(GEOMETRY_DIR, f"{service_id}.json")
-                if not os.path.isfile(path):
-                    filter_counters["Geometry missing"] += 1
-                    last_filter = "Geometry missing"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Geometry missing          ",
-                        end="\r",
-                    )
-                    continue
+def render_settings():  # every setting that can change how the output looks, as plain data so it can be hashed
+    # tuples become lists, the same as after a trip through the manifest
+    return {name: json.loads(json.dumps(globals()[name])) for name in sorted(CACHE_KEY_SETTINGS)}
 
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+def file_fingerprint(path):  # size and modified time, enough to tell a file has changed without reading it
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def input_fingerprints():  # the data files a map is drawn from
+    # geometry files are replaced rather than edited, so the folder changes too, the geometry index is left out because
+    # rechecking geometry rewrites it even when nothing was downloaded
+    paths = [ROUTES_CSV, OPERATOR_COLORS_CSV, CITIES_CSV, GEOMETRY_DIR]
+    if USE_GEOMETRY_PACK:
+        paths.append(GEOMETRY_PACK)
+    return {path: file_fingerprint(path) for path in paths}
+
+def render_manifest_entry():  # describes what the map about to be drawn depends on, maps with the same key look identical
+    entry = {
+        "mode": RENDER_MODE,
+        "cache_version": RENDER_CACHE_VERSION,
+        "settings": render_settings(),
+        "inputs": input_fingerprints(),
+    }
+    entry["key"] = hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+    return entry
+
+def load_render_manifest():  # {file name in MAPS_DIR: manifest entry}
+    if not os.path.isfile(RENDER_MANIFEST):
+        return {}
+    try:
+        with open(RENDER_MANIFEST, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"{Fore.YELLOW}Failed to read {RENDER_MANIFEST}, maps will be drawn again: {e}")
+        return {}
+
+def find_cached_render(manifest, key):  # file in MAPS_DIR drawn with the same key that is still there unchanged, or None
+    for output_file, entry in manifest.items():
+        if entry.get("key") == key and file_fingerprint(os.path.join(MAPS_DIR, output_file)) == entry.get("output"):
+            return output_file
+    return None
+
+def record_renders(renders):  # adds [(file name, manifest entry)] to the manifest, and forgets maps that have been deleted or changed
+    manifest = load_render_manifest()
+    for output_file, entry in renders:
+        entry["output"] = file_fingerprint(os.path.join(MAPS_DIR, output_file))
+        manifest[output_file] = entry
+    manifest = {
+        output_file: entry for output_file, entry in sorted(manifest.items())
+        if entry.get("output") and file_fingerprint(os.path.join(MAPS_DIR, output_file)) == entry["output"]
+    }
+    write_file_atomic(RENDER_MANIFEST, json.dumps(manifest, indent=1))
+
+def render_output(output_file=None):  # draws BOUNDING_BOX the way RENDER_MODE says and saves it in MAPS_DIR, returns (file name, manifest entry, False if an existing map was used)
+    extension = OUTPUT_EXTENSIONS.get(RENDER_MODE, ".png")
+    entry = render_manifest_entry()
+    manifest = load_render_manifest()
+    cached = find_cached_render(manifest, entry["key"]) if RENDER_CACHE else None
+    if cached:
+        if output_file is None:
+            output_file = cached
+        elif output_file != cached:
+            shutil.copyfile(os.path.join(MAPS_DIR, cached), os.path.join(MAPS_DIR, output_file))
+        print(f"{Fore.GREEN}Already drawn with the same settings and data {Fore.WHITE}- {Fore.YELLOW}{os.path.join(MAPS_DIR, output_file)}")
+        return output_file, entry, False
+
+    output_file = output_file or next_output_file(manifest, extension)
+    if TRACK_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    profiler = cProfile.Profile() if PROFILE_RUN else None
+    if profiler:
+        profiler.enable()
+    try:
+        if RENDER_MODE == "heatmap":
+            render_heatmap(output_file)
+        elif RENDER_MODE in ("svg", "geojson"):
+            export_vector(output_file)
+        else:
+            render_map(output_file)
+    finally:
+        if profiler:
+            profiler.disable()
+
+    # named after the whole file name, 1.png and 1.geojson can both be in MAPS_DIR
+    if profiler:
+        profiler.dump_stats(os.path.join(MAPS_DIR, output_file + ".prof"))
+    if RUN_REPORT:
+        run_report.save(os.path.join(MAPS_DIR, output_file + ".report.json"), output_file)
+        print(f"{Fore.CYAN}Run report saved to {Fore.YELLOW}{os.path.join(MAPS_DIR, output_file + '.report.json')}\n")
+    return output_file, entry, True
+
+def next_output_file(manifest, extension=".png"):  # number after the highest numbered map in the render manifest, so MAPS_DIR doesnt have to be listed
+    numbers = []
+    for filename in manifest:
+        if filename.lower().endswith(extension):
+            name_part = os.path.splitext(filename)[0]
+            if name_part.isdigit():
+                numbers.append(int(name_part))
 
-                geometry = data.get("geometry", {})
-                geom_type = geometry.get("type")
-                coords = geometry.get("coordinates")
+    number = max(numbers, default=0) + 1
+    while os.path.exists(os.path.join(MAPS_DIR, f"{number}{extension}")):  # drawn before the manifest existed, never overwrite it
+        number += 1
+    return f"{number}{extension}"
 
-                if geom_type == "LineString":
-                    coords = [
-                        coords
-                    ]  # wrap in list to reuse same logic as MultiLineString
-                elif geom_type == "MultiLineString":
-                    pass  # coords already in correct format
-                else:
-                    filter_counters["Invalid line data"] += 1
-                    last_filter = "Invalid line data"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Invalid line data          ",
-                        end="\r",
-                    )
-                    continue
 
-                if segment_too_long(coords, m_per_deg_lat, m_per_deg_lon):
-                    filter_counters["Segment too long"] += 1
-                    last_filter = "Segment too long"
-                    print(
-                        f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}Segment too long          ",
-                        end="\r",
-                    )
-                    continue
+def main():
+    ascii_art = f'''{Fore.RED}
+     .---------------------------.            .---------------------------.
+   .' .--..---..---..---..---..--⹁\\          /,--..---..---..---..---..--. `.
+   |_/___||___||___||___||___||___\\\\        //___||___||___||___||___||___\\_|
+   |_] ######################## __|]        [|__ ######################## [_|
+   |============================/              \\============================|
+   ||"""| |"""||"""||"""||"""|  |==.        .==|  |"""||"""||"""||"""| |"""||
+   ||=  |="---""---""---""---"======\\      /======"---""---""---""---"=|  =||
+   ||== |  ____          *[]    ____|      |____    []*          ____  | ==||
+   ||===| //  \\\\               //  \\\\      //  \\\\               //  \\\\ |===||
+   `+---+-"\__/"---------------"\__/"      "\__/"---------------"\__/"-+---+'
+{Fore.YELLOW}================================================================================{Fore.RED}
+ _    ____________  __  ____  ______________   ____________  {Fore.CYAN}  ____  __  _______{Fore.RED}
+| |  / / ____/ __ \/ / / /  |/  /  _/ ____/ | / /  _/ ___/ / {Fore.CYAN} / __ )/ / / / ___/{Fore.RED}
+| | / / __/ / /_/ / / / / /|_/ // // / __/  |/ // / \__ \|/ {Fore.CYAN} / __  / / / /\__ \ {Fore.RED}
+| |/ / /___/ _, _/ /_/ / /  / // // /_/ / /|  // / ___/ /  {Fore.CYAN} / /_/ / /_/ /___/ / {Fore.RED}
+|___/_____/_/_|_|\____/_/  /_/___/\____/_/ |_/___//____/ {Fore.CYAN}__/_____/\____//____/
+   /  |/  /   |  / __ \   / ____/ ____/ | / / ____/ __ \/   |/_  __/ __ \/ __ \ 
+  / /|_/ / /| | / /_/ /  / / __/ __/ /  |/ / __/ / /_/ / /| | / / / / / / /_/ / 
+ / /  / / ___ |/ ____/  / /_/ / /___/ /|  / /___/ _, _/ ___ |/ / / /_/ / _, _/  
+/_/  /_/_/  |_/_/       \____/_____/_/ |_/_____/_/ |_/_/  |_/_/  \____/_/ |_|   
 
-                drawn_count += 1
-                print(
-                    f"{Fore.CYAN}Drawing {Fore.YELLOW}{counter}{Fore.CYAN}/{Fore.GREEN}{total_routes} {Fore.CYAN}| Last filter: {Fore.YELLOW}{last_filter}          ",
-                    end="\r",
-                )
+'''
+    print(ascii_art)
 
-                for line in coords:
-                    if len(line) < 2:
-                        continue
-                    points = [
-                        geo_to_pixel(
-                            lon,
-                            lat,
-                            min_lon,
-                            max_lat,
-                            m_per_deg_lat,
-                            m_per_deg_lon,
-                            SCALE_M_PER_PX,
-                        )
-                        for lon, lat in line
-                    ]
-
-                    if HEADLESS_RENDERING:
-                        draw.line(points, fill=color, width=width)
-                    else:
-                        pygame.draw.lines(screen, color, False, points, width)
-
-                if DRAW_ROUTE_LABELS:
-                    route_labels.append(
-                        {
-                            "routeNumber": row["routeNumber"],
-                            "color": color,
-                            "points": points,
-                        }
-                    )
-
-                if not HEADLESS_RENDERING:
-                    pygame.display.flip()
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            pygame.quit()
-                            sys.exit()
+    problems = check_settings(globals())
+    if problems:
+        for problem in problems:
+            print(f"{Fore.RED}Settings not valid {Fore.WHITE}- {Fore.CYAN}{problem}")
+        return
 
-            except Exception as e:
-                print(
-                    f"Error processing service {row.get('serviceID', '?')}: {e}"
-                )  # should never happen
-                continue
+    if TRACK_MEMORY:
+        tracemalloc.start()  # started before the data is checked, so downloads and builds are in the report too
 
-    if HEADLESS_RENDERING:
-        draw_route_labels(draw, route_labels, m_per_deg_lat, m_per_deg_lon)
-        draw_city_labels(draw, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+    check_start = time.perf_counter()
+    check_data()  # make sure all data exists, if not, download it
+    run_report.time("check data", time.perf_counter() - check_start)  # a timer not a phase, the downloads and builds inside it are phases
 
-        image.save(os.path.join(MAPS_DIR, output_file))
-    else:
-        draw_route_labels(screen, route_labels, m_per_deg_lat, m_per_deg_lon)
-        draw_city_labels(screen, min_lon, max_lat, m_per_deg_lat, m_per_deg_lon)
+    if BATCH_JOBS:
+        render_batch()
+        return
 
-        pygame.display.flip()
-        pygame.image.save(screen, os.path.join(MAPS_DIR, output_file))
-        pygame.quit()
+    if DRY_RUN:
+        dry_run()
+        return
 
-    print(f"\n{Fore.GREEN}Finished drawing bus map.\n")
-    print(f"{Fore.CYAN}Total routes: {Fore.YELLOW}{counter}")
-    print(f"{Fore.CYAN}Drawn routes: {Fore.YELLOW}{drawn_count}\n")
-    print(f"{Fore.CYAN}Filtered routes:")
-    print(Fore.CYAN + "=" * 36)
+    if RENDER_MODE == "tiles":
+        render_tiles()
+        return
 
-    for reason, count in sorted(filter_counters.items()):
-        print(
-            f"{Fore.CYAN}| {Fore.YELLOW}{reason:<25}{Fore.CYAN}| {Fore.YELLOW}{count:<5} {Fore.CYAN}|"
-        )
+    if RENDER_MODE == "server":
+        serve_tiles()
+        return
 
-    print(Fore.CYAN + "=" * 36)
+    output_file, entry, _ = render_output(OUTPUT_NAME + OUTPUT_EXTENSIONS.get(RENDER_MODE, ".png") if OUTPUT_NAME else None)
+    record_renders([(output_file, entry)])
 
 
 if __name__ == "__main__":